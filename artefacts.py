@@ -0,0 +1,230 @@
+import numpy as np
+
+"""
+Find and fix elevation artefacts along roads.
+
+The DEM describes the ground, so where a road crosses a valley on a bridge its
+elevation follows the slope under the bridge: we see a steep descent, then a
+steep climb. A tunnel gives the opposite. We look for these along chains of
+connected segments and interpolate the elevation across them.
+
+Chains go on across road ends and junctions, so a bridge between two roads is
+found as well. Everything works on arrays with one element per segment.
+"""
+
+
+def _link_ends(p1, p2):
+    """ pair up segment ends which meet at the same point
+
+    Where two ends meet they're linked. At a junction we link the pair which
+    goes on the straightest, then the next straightest pair of the remaining
+    ends, and so on, as long as the angle between them is over 135°.
+
+    Ends are numbered 2*i for the start and 2*i + 1 for the end of segment i.
+    Returns (mate, node): the end linked to every end (-1 for none), and a
+    number for the point of every end """
+    n = len(p1)
+    points = np.stack((p1, p2), axis=1).reshape(-1, 2)
+    _, node = np.unique(points, axis=0, return_inverse=True)
+    node = node.ravel()
+    # direction away from the node
+    d = np.stack((p2 - p1, p1 - p2), axis=1).reshape(-1, 2)
+    norm = np.hypot(d[:, 0], d[:, 1])
+    d = d / np.where(norm > 0, norm, 1)[:, None]
+
+    mate = np.full(2 * n, -1)
+    order = np.argsort(node, kind='stable')
+    degree = np.bincount(node)
+    first = np.cumsum(degree) - degree
+
+    # two ends: always linked
+    two = first[degree == 2]
+    a, b = order[two], order[two + 1]
+    mate[a], mate[b] = b, a
+
+    # junctions: all pairs of ends at the same node
+    ends = order[np.repeat(degree, degree) > 2]
+    if len(ends):
+        nd = node[ends]
+        start = np.searchsorted(nd, nd)
+        count = np.bincount(nd)[nd]
+        i = np.repeat(np.arange(len(ends)), count)
+        j = np.repeat(start, count) + (np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count))
+        keep = i < j
+        i, j = ends[i[keep]], ends[j[keep]]
+        cos = np.sum(d[i] * d[j], axis=1)
+        keep = cos < -np.sqrt(0.5)
+        i, j, cos = i[keep], j[keep], cos[keep]
+        while len(i):
+            # the straightest pair at every node
+            by = np.lexsort((cos, node[i]))
+            i, j, cos = i[by], j[by], cos[by]
+            best = np.ones(len(i), dtype=bool)
+            best[1:] = node[i[1:]] != node[i[:-1]]
+            mate[i[best]], mate[j[best]] = j[best], i[best]
+            keep = (mate[i] < 0) & (mate[j] < 0)
+            i, j, cos = i[keep], j[keep], cos[keep]
+    return mate, node
+
+
+def _jump(nxt):
+    """ follow `nxt` to the end by pointer jumping: returns the last state and
+    the number of steps to it, for every state. States on a cycle get -1 as last
+    state, and the lowest state on the cycle in the third array """
+    n = len(nxt)
+    self = np.arange(n)
+    ptr = np.where(nxt >= 0, nxt, self)
+    dist = (nxt >= 0).astype(int)
+    low = np.minimum(self, ptr)
+    for _ in range(max(1, int(np.ceil(np.log2(max(n, 2))))) + 1):
+        dist = dist + dist[ptr]
+        low = np.minimum(low, low[ptr])
+        ptr = ptr[ptr]
+    last = np.where(nxt[ptr] >= 0, -1, ptr)
+    return last, dist, low
+
+
+def _follow(mate):
+    """ `chains`, from the linked ends """
+    n = len(mate) // 2
+
+    # a state 2*i + r follows segment i forward (r = 0) or backward (r = 1). It
+    # leaves through end state ^ 1, and the linked end is the next state
+    state = np.arange(2 * n)
+    last, dist, low = _jump(mate[state ^ 1])
+
+    # break a closed loop where it leaves its lowest state
+    cut = (last < 0) & (state == low) & (low < low[state ^ 1])
+    if np.any(cut):
+        out = state[cut] ^ 1
+        mate[mate[out]] = -1
+        mate[out] = -1
+        last, dist, low = _jump(mate[state ^ 1])
+
+    # every chain shows up twice, once in each direction. Keep the one which
+    # ends in the lower state
+    keep = state[last < last[state ^ 1]]
+    by = np.lexsort((-dist[keep], last[keep]))
+    keep = keep[by]
+    _, chain = np.unique(last[keep], return_inverse=True)
+    return keep // 2, (keep % 2).astype(bool), chain.ravel()
+
+
+def chains(p1, p2):
+    """ put connected segments in chains, see `_link_ends`
+
+    p1, p2: start and end points, shape (n, 2)
+
+    Returns (order, reverse, chain): the segments in chain order, whether each of
+    them is followed from end to start, and the chain of each of them """
+    if len(p1) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=bool), np.zeros(0, dtype=int)
+    return _follow(_link_ends(p1, p2)[0])
+
+
+def fix_artefacts(p1, p2, length, el1, el2, max_grade=0.25, max_span=500, min_grade=0.1, rel_grade=3):
+    """ interpolate the elevation across bridges and tunnels
+
+    A run of steep segments going down, followed by a run going up (or the
+    other way around) in the same chain, at most `max_span` long together,
+    encloses an artefact. Steep means a grade over `min_grade`, and the lesser
+    of the steepest grades of both runs must be either over `max_grade`, or over
+    `rel_grade` times the grade of the segments on either side. The nodes in
+    between get an elevation interpolated between the nodes on either side.
+
+    Returns (el1, el2, fixed), new elevations and a mask of the segments which changed """
+    n = len(length)
+    if n == 0:
+        return el1, el2, np.zeros(0, dtype=bool)
+    mate, node = _link_ends(p1, p2)
+    order, reverse, chain = _follow(mate)
+    seg_length = length[order]
+    seg_el1 = np.where(reverse, el2[order], el1[order])
+    seg_el2 = np.where(reverse, el1[order], el2[order])
+
+    # every chain has one node more than it has segments
+    start = np.arange(n) + chain
+    node_count = n + chain[-1] + 1
+    el = np.full(node_count, np.nan)
+    el[start] = seg_el1
+    el[start + 1] = seg_el2
+    pos = np.zeros(node_count)
+    pos[start + 1] = seg_length
+    pos = np.cumsum(pos)
+    node_chain = np.zeros(node_count, dtype=int)
+    node_chain[start] = chain
+    node_chain[start + 1] = chain
+
+    # runs of steep segments going the same way, in the same chain
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grade = (seg_el2 - seg_el1) / seg_length
+    steep = np.flatnonzero(np.abs(grade) > min_grade)
+    if len(steep) == 0:
+        return el1, el2, np.zeros(n, dtype=bool)
+    sign = np.sign(grade[steep])
+    new_run = np.ones(len(steep), dtype=bool)
+    new_run[1:] = (chain[steep[1:]] != chain[steep[:-1]]) | (sign[1:] != sign[:-1]) | (steep[1:] != steep[:-1] + 1)
+    run_start = np.flatnonzero(new_run)
+    first = steep[run_start]
+    last = steep[np.append(run_start[1:], len(steep)) - 1]
+    peak = np.maximum.reduceat(np.abs(grade[steep]), run_start)
+    run_sign = sign[run_start]
+
+    # pair every run with the next one
+    a, b = np.arange(len(first) - 1), np.arange(1, len(first))
+    pair = (chain[first[a]] == chain[first[b]]) & (run_sign[a] != run_sign[b]) & \
+        (pos[start[last[b]] + 1] - pos[start[first[a]]] <= max_span)
+    a, b = a[pair], b[pair]
+
+    # the grade next to the pair, if there is a segment in the same chain
+    before, after = first[a] - 1, last[b] + 1
+    g_before = np.where((before >= 0) & (chain[np.maximum(before, 0)] == chain[first[a]]),
+        np.abs(grade[np.maximum(before, 0)]), np.nan)
+    g_after = np.where((after < n) & (chain[np.minimum(after, n - 1)] == chain[first[a]]),
+        np.abs(grade[np.minimum(after, n - 1)]), np.nan)
+    around = np.fmax(g_before, g_after)
+    around[np.isnan(around)] = np.inf
+    depth = np.minimum(peak[a], peak[b])
+    pair = (depth > max_grade) | (depth > rel_grade * around)
+    a, b = a[pair], b[pair]
+
+    # flag the nodes from the end of the first segment of the first run, to the
+    # start of the last segment of the second run
+    mark = np.zeros(node_count + 1, dtype=int)
+    np.add.at(mark, start[first[a]] + 1, 1)
+    np.add.at(mark, start[last[b]] + 1, -1)
+    flagged = np.cumsum(mark[:-1]) > 0
+
+    # nearest good node on either side
+    good = ~flagged & np.isfinite(el)
+    idx = np.arange(node_count)
+    left = np.maximum.accumulate(np.where(good, idx, -1))
+    right = np.minimum.accumulate(np.where(good, idx, node_count)[::-1])[::-1]
+    fix = flagged & (left >= 0) & (right < node_count)
+    fix[fix] = (node_chain[left[fix]] == node_chain[fix]) & (node_chain[right[fix]] == node_chain[fix]) \
+        & (pos[right[fix]] > pos[left[fix]])
+
+    l, r = left[fix], right[fix]
+    t = (pos[fix] - pos[l]) / (pos[r] - pos[l])
+    el = el.copy()
+    el[fix] = el[l] + t * (el[r] - el[l])
+
+    # back to the original segments. Other roads which meet at a fixed node
+    # get its new elevation too
+    new_el = np.full(2 * n, np.nan)
+    new_el[2 * order + reverse] = el[start]
+    new_el[2 * order + ~reverse] = el[start + 1]
+    node_fixed = np.zeros(node.max() + 1, dtype=bool)
+    # a node shows up once for every road at it, so `|=` would lose values
+    np.logical_or.at(node_fixed, node[2 * order + reverse], fix[start])
+    np.logical_or.at(node_fixed, node[2 * order + ~reverse], fix[start + 1])
+    node_el = np.full(len(node_fixed), np.nan)
+    fixed_ends = np.zeros(2 * n, dtype=bool)
+    fixed_ends[2 * order + reverse] = fix[start]
+    fixed_ends[2 * order + ~reverse] = fix[start + 1]
+    node_el[node[fixed_ends]] = new_el[fixed_ends]
+    fixed_ends = node_fixed[node]
+    new_el[fixed_ends] = node_el[node[fixed_ends]]
+
+    fixed = fixed_ends[0::2] | fixed_ends[1::2]
+    return new_el[0::2], new_el[1::2], fixed
@@ -0,0 +1,61 @@
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from blur import *
+
+"""
+Compare the blur engines for speed and accuracy, on an image which looks like
+an accumulated road image: mostly empty, with lines of weighted pixels.
+The reference is the scipy engine. Below a radius of BOX_MIN_SIGMA the box
+engine is scipy too.
+"""
+
+parser = argparse.ArgumentParser(description="Compare the speed and accuracy of the blur engines")
+parser.add_argument("--size", type=int, default=2000, metavar='PIXELS', help="Width and height of the test image")
+parser.add_argument("--blur", type=float, nargs='+', default=[2, 10, 40], metavar='RADIUS', help="Radii (standard deviation) to try")
+parser.add_argument("--repeat", type=int, default=3, metavar='N', help="Take the best time of N runs")
+args = parser.parse_args()
+
+
+def test_image(size, seed=1):
+    """ random walks, with weights like (misery index × length, length) """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((size, size, 2))
+    steps = rng.integers(-1, 2, (size // 2, size * 2, 2))
+    start = rng.integers(0, size, (size // 2, 1, 2))
+    xy = np.clip(start + np.cumsum(steps, axis=1), 0, size - 1).reshape(-1, 2)
+    weight = rng.uniform(1, 50, len(xy))
+    np.add.at(img, (xy[:, 1], xy[:, 0], 0), weight * rng.uniform(0, 3, len(xy)))
+    np.add.at(img, (xy[:, 1], xy[:, 0], 1), weight)
+    return img
+
+
+def timed(f):
+    best = np.inf
+    for _ in range(args.repeat):
+        t0 = perf_counter()
+        result = f()
+        best = min(best, perf_counter() - t0)
+    return best, result
+
+
+img = test_image(args.size)
+print(f"{args.size}×{args.size} pixels")
+print(f"{'radius':>6} {'engine':>6} {'time (s)':>9} {'max error':>10} {'error in MI':>11}")
+
+for sigma in args.blur:
+    ref = None
+    for engine in BLUR_ENGINES:
+        t, out = timed(lambda: gaussian_blur(img, sigma, engine))
+        if ref is None:
+            ref = out
+            # the misery index is the ratio of the channels, where there is enough weight
+            enough = ref[:, :, 1] > .01 * ref[:, :, 1].max()
+            ref_mi = ref[enough, 0] / ref[enough, 1]
+        err = np.max(np.abs(out - ref)) / np.max(np.abs(ref))
+        # box filters reach less far, so they can leave some pixels empty
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mi_err = np.nanmax(np.abs(out[enough, 0] / out[enough, 1] - ref_mi))
+        print(f"{sigma:6.1f} {engine:>6} {t:9.3f} {err:10.2e} {mi_err:11.2e}")
@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d, uniform_filter1d
+from scipy.signal import fftconvolve
+
+"""
+Gaussian blur of a (height, width, channels) image, with a choice of engine:
+
+ - scipy: `gaussian_filter1d` in double precision. The cost per pixel grows
+   with the radius.
+ - box: three box filters in a row, which is close to a Gaussian. Every box
+   filter is a running sum, so the cost doesn’t depend on the radius. Below a
+   radius of `BOX_MIN_SIGMA` the boxes are too coarse (under 0.8 they are a
+   single pixel: no blur at all), so there we use scipy, which is cheap anyway.
+   See blur-benchmark.py for the error at larger radii.
+ - fft: convolution with the same kernel as scipy, through an FFT.
+
+box and fft work in single precision, on one channel at a time. All engines
+treat the edges of the image like scipy does: the image is mirrored.
+"""
+
+BLUR_ENGINES = ('scipy', 'box', 'fft')
+
+# smallest radius for the box engine
+BOX_MIN_SIGMA = 8
+
+
+def box_sizes(sigma, n=3):
+    """ widths of `n` box filters which together approximate a Gaussian with
+    standard deviation `sigma`. The widths are odd, so the boxes are centred """
+    w_ideal = np.sqrt(12 * sigma * sigma / n + 1)
+    wl = int(w_ideal)
+    if wl % 2 == 0:
+        wl -= 1
+    wu = wl + 2
+    m = round((12 * sigma * sigma - n * wl * wl - 4 * n * wl - 3 * n) / (-4 * wl - 4))
+    return [wl] * m + [wu] * (n - m)
+
+
+def gaussian_kernel(sigma):
+    """ the kernel `gaussian_filter1d` uses """
+    radius = int(4 * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    k = np.exp(-0.5 * x * x / (sigma * sigma))
+    return k / k.sum()
+
+
+def _engine(sigma, engine):
+    """ the engine we actually use for this radius """
+    if engine == 'box' and sigma < BOX_MIN_SIGMA:
+        return 'scipy'
+    return engine
+
+
+def blur_radius(sigma, engine='scipy'):
+    """ how far the blur reaches, in pixels. Pixels further away from an edge
+    than this aren’t affected by what is beyond it """
+    if _engine(sigma, engine) == 'box':
+        return sum((w - 1) // 2 for w in box_sizes(sigma))
+    return int(4 * sigma + 0.5)
+
+
+def _blur_channel(img, sigma, engine):
+    for axis in (0, 1):
+        if engine == 'box':
+            for w in box_sizes(sigma):
+                img = uniform_filter1d(img, w, axis, mode='reflect')
+        else:
+            k = gaussian_kernel(sigma).astype(img.dtype)
+            r = len(k) // 2
+            pad = [(0, 0), (0, 0)]
+            pad[axis] = (r, r)
+            # numpy’s symmetric padding is scipy’s reflect mode
+            img = fftconvolve(np.pad(img, pad, mode='symmetric'), np.expand_dims(k, 1 - axis), mode='valid')
+    return img
+
+
+def gaussian_blur(img, sigma, engine='scipy'):
+    """ blur an image of shape (height, width, channels) along its first two axes
+
+    A radius of 0 doesn’t blur """
+    if sigma <= 0:
+        return img
+    engine = _engine(sigma, engine)
+    if engine == 'scipy':
+        img = gaussian_filter1d(img, sigma, 0)
+        return gaussian_filter1d(img, sigma, 1)
+
+    out = np.empty(img.shape, dtype=np.float32)
+    for c in range(img.shape[2]):
+        out[:, :, c] = _blur_channel(np.ascontiguousarray(img[:, :, c], dtype=np.float32), sigma, engine)
+    return out
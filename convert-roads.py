@@ -0,0 +1,23 @@
+#! python3
+
+"""
+Convert a road file with elevation data to another format, see roadio.py.
+
+This is how the makefile gets its GeoParquet road file from a GeoJSON road
+file made earlier, when you don’t have the roads data set and the DEM to run
+make-elevation.py.
+"""
+
+import argparse
+
+from roadio import *
+
+
+parser = argparse.ArgumentParser(description="Convert a road file with elevation data")
+parser.add_argument("road", metavar='ROADS-ELEVATION.GEOJSON', help="Road file, the format follows from the extension")
+parser.add_argument("--output", "-o", metavar='ROADS-ELEVATION.PARQUET', required=True, help="Output file, the format follows from the extension")
+args = parser.parse_args()
+
+roads = read_roads(args.road)
+write_roads(roads, args.output)
+print("written " + args.output)
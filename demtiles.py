@@ -0,0 +1,337 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from glob import iglob
+import json
+import os
+import threading
+
+import numpy as np
+import rasterio
+
+from bbox import *
+
+"""
+Access to a digital elevation model which comes as a regular grid of tiles.
+
+Only the headers of the tiles are read up front, the elevation data itself is
+read when we need it.
+"""
+
+
+def read_sidecar(f):
+    """ guess the file name of the sidecar file and read it """
+
+    assert f[-4] == '.'
+    # sidecar file name:
+    f = f[:-4] + '.' + f[-3] + f[-1] + 'w'
+    with open(f) as tfwf:
+        tfw = tuple(tfwf)
+        scale = float(tfw[0].strip())
+        x, y = ( float(tfw[4].strip()), float(tfw[5].strip()))
+        return x, y, scale
+
+
+# the DEM from LINZ comes in two formats: kea and tiff
+def image_files(d):
+    yield from iglob(os.path.join(d, "*.tif"))
+    yield from iglob(os.path.join(d, "*.kea"))
+
+
+def read_tile_header(f):
+    """ describe a tile without reading its pixels
+
+    returns a SrcTile without image """
+    with rasterio.open(f) as raster:
+        size = (raster.width, raster.height)
+
+    # The *.kea files don’t have any georeference data in them.
+    x, y, scale = read_sidecar(f)
+    w, h = size[0] * scale, size[1] * scale
+    bbox = BBOX(x - 0.5 * scale, y - h + 0.5 * scale, w, h)
+    return SrcTile(bbox, f, None, scale)
+
+
+def file_stamp(f):
+    """ a string which changes when a file changes: its name, modification time and size """
+    st = os.stat(f)
+    return f'{os.path.basename(f)}:{st.st_mtime_ns}:{st.st_size}'
+
+
+def read_tile_headers(files, jobs=1, index=None):
+    """ `read_tile_header` for a list of files, on `jobs` threads
+
+    `index` is a JSON file which remembers the tiles from an earlier run. Only
+    tiles which are new or changed since then are opened, and the index is
+    updated afterwards.
+
+    yields a SrcTile without image per file, in order """
+    known = {}
+    if index and os.path.exists(index):
+        with open(index) as indexf:
+            known = json.load(indexf)
+
+    stamps = [file_stamp(f) for f in files]
+
+    def header(f, stamp):
+        entry = known.get(f, None)
+        if entry is not None and entry['stamp'] == stamp:
+            return SrcTile(BBOX(*entry['bbox']), f, None, entry['scale'])
+        return read_tile_header(f)
+
+    # most of the time goes to waiting for the file system, so threads help
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        tlist = []
+        for t in pool.map(header, files, stamps):
+            tlist.append(t)
+            yield t
+
+    if index:
+        with open(index, 'w') as indexf:
+            json.dump({t.f: dict(stamp=stamp, bbox=t.bbox, scale=t.scale) for t, stamp in zip(tlist, stamps)}, indexf)
+
+
+def morton_key(ix, iy):
+    """ interleave the bits of two arrays of non-negative integers
+
+    Sorting on this key visits grid cells along a Z-order curve, so cells
+    which are close together are also visited close together. """
+    def spread(v):
+        v = v.astype(np.uint64) & 0xffffffff
+        v = (v | (v << 16)) & 0x0000ffff0000ffff
+        v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+        v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+        v = (v | (v << 2)) & 0x3333333333333333
+        v = (v | (v << 1)) & 0x5555555555555555
+        return v
+    return spread(ix) | (spread(iy) << 1)
+
+
+class TileStore:
+    """ A grid of DEM tiles which are loaded on demand
+
+    Decoded tiles are kept in a LRU cache which holds at most `cache_size` tiles.
+    With `jobs` > 1 tiles are read and sampled on that many threads. """
+
+    def __init__(self, tlist, cache_size=4, jobs=1):
+        # These images come from a regular grid.
+        # Reconstruct this grid, and create a lookup table from cell coordinate to
+        # image
+
+        # assume the largest of those images fills exactly one cell
+        self.grid_w = max(t.bbox.w for t in tlist)
+        self.grid_h = max(t.bbox.h for t in tlist)
+        self.grid_x0 = None
+        self.grid_y0 = None
+
+        self.bbox_total = BBOX.with_xyxy(
+            min(t.bbox.x for t in tlist),
+            min(t.bbox.y for t in tlist),
+            max(t.bbox.x2() for t in tlist),
+            max(t.bbox.y2() for t in tlist))
+
+        # the origin is a corner of a full size tile
+        for t in tlist:
+            if t.bbox.w == self.grid_w and t.bbox.h == self.grid_h:
+                self.grid_x0 = t.bbox.x
+                self.grid_y0 = t.bbox.y
+                break
+
+        assert self.grid_x0, "We are missing the grid"
+
+        # now, the lookup table
+        self.tmap = {}
+        for t in tlist:
+            self.tmap[self.tile_index((t.bbox.x, t.bbox.y))] = t
+
+        self.cache_size = cache_size
+        self.jobs = jobs
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def tile_index(self, point):
+        return (int(point[0] - self.grid_x0) // self.grid_w, int(point[1] - self.grid_y0) // self.grid_h)
+
+    def tile_indices(self, xy):
+        """ `tile_index` for an array of points, returns two arrays """
+        ix = np.trunc(xy[:, 0] - self.grid_x0) // self.grid_w
+        iy = np.trunc(xy[:, 1] - self.grid_y0) // self.grid_h
+        return ix, iy
+
+    def stamps(self, bounds):
+        """ a string per bounding box (shape (n, 4), as from `shapely.bounds`), which
+        changes when a tile it overlaps changes (its modification time or size) """
+        tile_stamp = {cell: self.file_stamp(t.f) for cell, t in self.tmap.items()}
+
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        ix0, iy0 = self.tile_indices(bounds[:, :2])
+        ix1, iy1 = self.tile_indices(bounds[:, 2:])
+        return [';'.join(tile_stamp.get((x, y), '-') for x in np.arange(x0, x1 + 1) for y in np.arange(y0, y1 + 1))
+                for x0, y0, x1, y1 in zip(ix0, iy0, ix1, iy1)]
+
+    def file_stamp(self, f):
+        return file_stamp(f)
+
+    def group_by_tile(self, xy):
+        """ group an array of points by the grid cell they fall in
+
+        yields the cell index and the indices (into `xy`) of the points in that cell.
+        Every cell is visited once, in Z-order. """
+        ix, iy = self.tile_indices(xy)
+        if len(ix) == 0:
+            return
+        cells, inverse = np.unique(np.stack((ix, iy), axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(cells) + 1))
+        cell_order = np.argsort(morton_key(cells[:, 0] - cells[:, 0].min(), cells[:, 1] - cells[:, 1].min()), kind='stable')
+        for k in cell_order:
+            yield tuple(cells[k]), order[bounds[k]:bounds[k + 1]]
+
+    def image(self, tile):
+        """ the elevation data of a tile, read from disk if it isn’t cached """
+        with self._lock:
+            img = self._cache.get(tile.f, None)
+            if img is not None:
+                self._cache.move_to_end(tile.f)
+                return img
+
+        # rasterio releases the GIL while decoding, so other threads can go on
+        with rasterio.open(tile.f) as raster:
+            img = raster.read(1)
+
+        with self._lock:
+            self.loads += 1
+            self._cache[tile.f] = img
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        return img
+
+    def tile_heights(self, tile, xy):
+        """ look up the elevation of an array of points which all fall in `tile` """
+        img = self.image(tile)
+        px = np.clip(xy[:, 0] - tile.bbox.x, 0, tile.bbox.w - 1) / tile.scale
+        py = np.clip(xy[:, 1] - tile.bbox.y, 0, tile.bbox.h - 1) / tile.scale
+        h = img[(tile.bbox.h - 1 - py).astype(int), px.astype(int)].astype(float)
+        h[h < -100] = np.nan
+        h[h < 0] = 0
+        return h
+
+    def elevations(self, xy):
+        """ look up the elevation of an array of points (shape (n, 2))
+
+        Points are processed tile by tile, so if you pass all your points in one
+        go every tile is read only once.
+
+        Returns an array of n elevations, NaN where we have no data. """
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        result = np.full(len(xy), np.nan)
+
+        # every tile writes to its own set of indices, so the order in which
+        # the tiles are done doesn’t change the result
+        def sample(bucket):
+            cell, idx = bucket
+            tile = self.tmap.get(cell, None)
+            if tile is not None:
+                result[idx] = self.tile_heights(tile, xy[idx])
+
+        if self.jobs > 1:
+            with ThreadPoolExecutor(self.jobs) as pool:
+                # consume the results, so exceptions are raised here
+                for _ in pool.map(sample, self.group_by_tile(xy)):
+                    pass
+        else:
+            for bucket in self.group_by_tile(xy):
+                sample(bucket)
+        return result
+
+
+MOSAIC_MAGIC = b'DEM-MOSAIC\n'
+MOSAIC_ALIGN = 4096
+MOSAIC_NODATA = -9999
+
+
+def mosaic_offset(size):
+    """ where the image data starts, after a header of `size` bytes """
+    return -(-(len(MOSAIC_MAGIC) + 8 + size) // MOSAIC_ALIGN) * MOSAIC_ALIGN
+
+
+def read_mosaic_header(f):
+    """ the header of a mosaic file, and the offset of the image data """
+    with open(f, 'rb') as mf:
+        assert mf.read(len(MOSAIC_MAGIC)) == MOSAIC_MAGIC, f"{f} is not a DEM mosaic"
+        size = int.from_bytes(mf.read(8), 'little')
+        header = json.loads(mf.read(size).decode('utf-8'))
+    return header, mosaic_offset(size)
+
+
+def build_mosaic(f, tlist):
+    """ copy all tiles into one mosaic file
+
+    The file starts with a JSON header with the grid and the tiles, followed by
+    one float32 image covering all tiles. Gaps are filled with a no-data value. """
+    store = TileStore(tlist)
+    scale = tlist[0].scale
+    assert all(t.scale == scale for t in tlist), "all tiles need the same scale for a mosaic"
+    bbox = store.bbox_total
+    width, height = round(bbox.w / scale), round(bbox.h / scale)
+
+    header = dict(
+        x=bbox.x, y=bbox.y, width=width, height=height, scale=scale,
+        grid_x0=store.grid_x0, grid_y0=store.grid_y0, grid_w=store.grid_w, grid_h=store.grid_h,
+        tiles=[dict(f=t.f, bbox=t.bbox, scale=t.scale, stamp=file_stamp(t.f)) for t in tlist])
+    data = json.dumps(header).encode('utf-8')
+    offset = mosaic_offset(len(data))
+
+    with open(f, 'wb') as mf:
+        mf.write(MOSAIC_MAGIC)
+        mf.write(len(data).to_bytes(8, 'little'))
+        mf.write(data)
+        mf.truncate(offset + width * height * 4)
+
+    mosaic = np.memmap(f, dtype=np.float32, mode='r+', offset=offset, shape=(height, width))
+    mosaic[:] = MOSAIC_NODATA
+    for i, t in enumerate(tlist):
+        col, row = round((t.bbox.x - bbox.x) / scale), round((bbox.y2() - t.bbox.y2()) / scale)
+        with rasterio.open(t.f) as raster:
+            img = raster.read(1)
+        mosaic[row:row + img.shape[0], col:col + img.shape[1]] = img
+        print(end=f'{i + 1}/{len(tlist)} DEM tiles copied\r', flush=True)
+    print()
+    mosaic.flush()
+    del mosaic
+
+
+def mosaic_is_current(f, files):
+    """ does the mosaic file exist, and was it made from exactly these (unchanged) files """
+    if not os.path.exists(f):
+        return False
+    header, _ = read_mosaic_header(f)
+    return sorted(t['stamp'] for t in header['tiles']) == sorted(file_stamp(g) for g in files)
+
+
+class MosaicStore(TileStore):
+    """ A grid of DEM tiles which was copied into one mosaic file (see `build_mosaic`)
+
+    The mosaic is memory mapped, so there is nothing to decode, and pages of
+    the file are shared with other processes reading it. """
+
+    def __init__(self, f, jobs=1):
+        header, offset = read_mosaic_header(f)
+        tlist = [SrcTile(BBOX(*t['bbox']), t['f'], None, t['scale']) for t in header['tiles']]
+        super().__init__(tlist, cache_size=0, jobs=jobs)
+        self._stamps = {t['f']: t['stamp'] for t in header['tiles']}
+        self._header = header
+        self.mosaic = np.memmap(f, dtype=np.float32, mode='r', offset=offset, shape=(header['height'], header['width']))
+
+    def file_stamp(self, f):
+        return self._stamps[f]
+
+    def image(self, tile):
+        """ the elevation data of a tile, as a view on the mosaic """
+        h = self._header
+        col = round((tile.bbox.x - h['x']) / h['scale'])
+        row = round((h['y'] + h['height'] * h['scale'] - tile.bbox.y2()) / h['scale'])
+        return self.mosaic[row:row + round(tile.bbox.h / tile.scale), col:col + round(tile.bbox.w / tile.scale)]
@@ -1,4 +1,5 @@
 from math import floor
+import shapely
 from shapely.geometry import LineString
 import numpy as np
 
@@ -55,6 +56,187 @@ def split_line(line, dist_limit):
             
         return new_list
 
+def ranges(start, count):
+    """ concatenation of `np.arange(s, s + c)` for every s, c in start, count """
+    offset = np.cumsum(count) - count
+    return np.arange(np.sum(count)) - np.repeat(offset - start, count)
+
+def split_lines(lines, dist_limit):
+    """ split an array of lines into lines of at most dist_limit length
+
+    This gives the same result as calling `split_line` on every line, but works on
+    the coordinates of all lines at once.
+
+    parameters:
+     - lines: array of shapely.geometry.LineString to split
+     - dist_limit: the maximal distance you’d like to have
+
+    return: (new_lines, line_index): array of shapely.geometry.LineString, and for
+            each of them the index of the line it came from. Any vertex of a line
+            is guaranteed to be a vertex in one or two of the returned lines.
+    """
+    lines = np.asarray(lines)
+    coords, vertex_line = shapely.get_coordinates(lines, return_index=True)
+    vertex_count = np.bincount(vertex_line, minlength=len(lines))
+    line_first = np.cumsum(vertex_count) - vertex_count
+    long_line = shapely.length(lines) > dist_limit
+
+    # segment lengths, and how many parts each segment is broken up in.
+    # Too large segments are split in some amount of even parts, using some tolerance
+    same_line = vertex_line[1:] == vertex_line[:-1]
+    p1, p2 = coords[:-1][same_line], coords[1:][same_line]
+    dist = np.sqrt(np.sum((p1 - p2)**2, axis=1))
+    parts = np.where(
+        (dist >= dist_limit * 1.5) & long_line[vertex_line[:-1][same_line]],
+        np.floor(dist / dist_limit + 0.5), 1).astype(int)
+
+    # new list of coordinates: the first vertex of each line, followed by
+    # the parts of each segment
+    seg_line = vertex_line[:-1][same_line]
+    k = ranges(1, parts)
+    n = np.repeat(parts, parts)
+    filled = np.repeat((p2 - p1) / parts[:, None], parts, axis=0) * k[:, None] + np.repeat(p1, parts, axis=0)
+    filled[k == n] = np.repeat(p2, parts, axis=0)[k == n]
+    filled_dist = np.repeat(dist / parts, parts)
+
+    new_count = vertex_count + np.bincount(seg_line, weights=parts - 1, minlength=len(lines)).astype(int)
+    new_first = np.cumsum(new_count) - new_count
+    new_coords = np.empty((np.sum(new_count), 2))
+    new_coords[new_first] = coords[line_first]
+    is_first = np.zeros(len(new_coords), dtype=bool)
+    is_first[new_first] = True
+    new_coords[~is_first] = filled
+
+    # distance along all lines, per vertex. The end of one line has the same
+    # distance as the start of the next one
+    seg_dist = np.zeros(len(new_coords))
+    seg_dist[~is_first] = filled_dist
+    along = np.cumsum(seg_dist)
+    new_last = new_first + new_count - 1
+
+    # group coordinates in new lines, ensuring that no line is too long.
+    # Lines which are short enough are kept as they are. For the others we
+    # add the pieces of all lines in parallel.
+    # Like `split_line`, the first segment of every piece but the first one
+    # counts twice.
+    a = new_first[long_line]
+    last = new_last[long_line]
+    line = np.nonzero(long_line)[0]
+    extra = np.zeros(len(a))
+    pieces = [(new_first[~long_line], new_last[~long_line], np.nonzero(~long_line)[0])]
+
+    while len(a):
+        j = np.searchsorted(along, along[a] + dist_limit - extra, side='right')
+        # a piece must have some length
+        lower = np.where(extra > 0, a + 1, np.maximum(a + 1, np.searchsorted(along, along[a], side='right')))
+        e = np.minimum(np.maximum(j - 1, lower), last)
+        keep = (extra > 0) | (along[e] > along[a])
+        pieces.append((a[keep], e[keep], line[keep]))
+
+        more = e < last
+        a, last, line = e[more], last[more], line[more]
+        extra = along[a + 1] - along[a]
+
+    piece_first, piece_last, line_index = (np.concatenate(p) for p in zip(*pieces))
+    order = np.argsort(piece_first, kind='stable')
+    piece_first, piece_last, line_index = piece_first[order], piece_last[order], line_index[order]
+
+    piece_count = piece_last - piece_first + 1
+    new_lines = shapely.linestrings(
+        new_coords[ranges(piece_first, piece_count)],
+        indices=np.repeat(np.arange(len(piece_first)), piece_count))
+    return new_lines, line_index
+
+def grid_lengths(lines, origin, cell):
+    """ the length of each line in every cell of a square grid it crosses
+
+    parameters:
+     - lines: array of shapely.geometry.LineString
+     - origin: (x, y) of a corner of the grid
+     - cell: the size of the grid cells
+
+    return: (ix, iy, length, line_index): for every piece of a line in a cell the
+            coordinates of that cell (counting from `origin`), the length of the
+            piece and the index of the line.
+    """
+    coords, vertex_line = shapely.get_coordinates(np.asarray(lines), return_index=True)
+    same_line = vertex_line[1:] == vertex_line[:-1]
+    p1 = (coords[:-1][same_line] - origin) / cell
+    p2 = (coords[1:][same_line] - origin) / cell
+    edge_line = vertex_line[:-1][same_line]
+    d = p2 - p1
+    edge_length = np.sqrt(np.sum(d**2, axis=1)) * cell
+
+    # where does every edge cross a grid line, as a fraction t along the edge.
+    # Every edge also gets t = 0 and t = 1
+    t_list = [np.zeros(len(d)), np.ones(len(d))]
+    edge_list = [np.arange(len(d))] * 2
+    for axis in (0, 1):
+        f1, f2 = np.floor(p1[:, axis]), np.floor(p2[:, axis])
+        count = np.abs(f2 - f1).astype(int)
+        edge = np.repeat(np.arange(len(d)), count)
+        k = ranges(0, count)
+        grid = np.where(d[edge, axis] > 0, f1[edge] + 1 + k, f1[edge] - k)
+        t_list.append((grid - p1[edge, axis]) / d[edge, axis])
+        edge_list.append(edge)
+
+    t = np.concatenate(t_list)
+    edge = np.concatenate(edge_list)
+    order = np.lexsort((t, edge))
+    t, edge = t[order], edge[order]
+
+    # the pieces between consecutive values of t
+    same_edge = edge[1:] == edge[:-1]
+    t1, t2, edge = t[:-1][same_edge], t[1:][same_edge], edge[:-1][same_edge]
+    length = (t2 - t1) * edge_length[edge]
+    mid = p1[edge] + d[edge] * ((t1 + t2) / 2)[:, None]
+
+    keep = length > 0
+    cell_xy = np.floor(mid[keep]).astype(int)
+    return cell_xy[:, 0], cell_xy[:, 1], length[keep], edge_line[edge[keep]]
+
+def sample_points(lines, interval):
+    """ evenly spaced points along each line, including both end points
+
+    parameters:
+     - lines: array of shapely.geometry.LineString
+     - interval: the maximal distance between two points
+
+    return: (xy, line_index, dist): the coordinates of the points as an (n, 2) array,
+            the index of the line for each point and the distance along that line.
+            The points of each line are consecutive, starting at the first vertex.
+    """
+    lines = np.asarray(lines)
+    length = shapely.length(lines)
+    count = np.maximum(np.ceil(length / interval), 1).astype(int) + 1
+    line_index = np.repeat(np.arange(len(lines)), count)
+    first = np.cumsum(count) - count
+    step = np.arange(len(line_index)) - first[line_index]
+    dist = step * (length / (count - 1))[line_index]
+    xy = shapely.get_coordinates(shapely.line_interpolate_point(lines[line_index], dist))
+    return xy, line_index, dist
+
+def fill_profile_gaps(el, line_index, dist):
+    """ interpolate missing (NaN) samples of elevation profiles, from the
+    samples on either side along the same line
+
+    parameters: the samples as `sample_points` returns them, and their elevation
+
+    return: the elevations. Samples at the start or the end of a line which
+            have no data stay NaN
+    """
+    good = np.isfinite(el)
+    idx = np.arange(len(el))
+    left = np.maximum.accumulate(np.where(good, idx, -1))
+    right = np.minimum.accumulate(np.where(good, idx, len(el))[::-1])[::-1]
+    gap = ~good & (left >= 0) & (right < len(el))
+    gap[gap] = (line_index[left[gap]] == line_index[gap]) & (line_index[right[gap]] == line_index[gap])
+
+    l, r = left[gap], right[gap]
+    el = el.copy()
+    el[gap] = el[l] + (dist[gap] - dist[l]) / (dist[r] - dist[l]) * (el[r] - el[l])
+    return el
+
 if __name__ == '__main__':
     np.set_printoptions(precision=2, suppress=True)
     line = LineString([
@@ -1,24 +1,42 @@
 import argparse
-from glob import iglob
+import hashlib
 import json
 import os
 import re
 
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import LineString
+import shapely
 import numpy as np
-import rasterio
 
 from bbox import *
+from artefacts import *
+from demtiles import *
 from lineops import *
+from roadio import *
+from roadsource import *
 
 parser = argparse.ArgumentParser(description="Load road shapefile and create a new shape file with elevation data")
-parser.add_argument("road", metavar='ROADS.SHP', help="Shapefile with roads")
+parser.add_argument("road", metavar='ROADS.SHP', help="Shapefile with roads, or an OpenStreetMap extract (.osm.pbf)")
 parser.add_argument("dem", metavar='DEM_DIR', help="Directory with LIDAR data tiles")
 parser.add_argument("--test", action='store_true', help="Load only a small set of tiles, and show a plot. This is useful to test alignment")
+parser.add_argument("--tile-cache", type=int, default=4, metavar='N', help="Keep at most this many decoded DEM tiles in memory")
+parser.add_argument("--jobs", "-j", type=int, default=1, metavar='N', help="Read and sample DEM tiles on N threads")
+parser.add_argument("--tile-index", metavar='INDEX.JSON', help="Remember the location of every DEM tile in this file, so later runs only open new or changed tiles")
+parser.add_argument("--mosaic", metavar='MOSAIC.RAW', help="Copy the DEM tiles into this memory mapped file, and sample from it. Later runs reuse it, unless the tiles changed")
+parser.add_argument("--osm-classes", metavar='CLASSES.INI', help="For OpenStreetMap data: a [highway] section which maps highway tags to a road type, L or M. Other roads are skipped")
+parser.add_argument("--crs", default='EPSG:2193', help="For OpenStreetMap data: the projection of the DEM")
+parser.add_argument("--osm-index", default='sparse_file_array', metavar='TYPE', help="For OpenStreetMap data: where to keep node locations, an osmium index type. The default sparse_file_array (or dense_file_array for large extracts) uses a temporary file, flex_mem keeps them in memory")
+parser.add_argument("--clip", action='store_true', help="Only load roads which overlap the extent of the DEM")
 parser.add_argument("--dist-limit", type=float, default=100, metavar='LENGTH', help="Subdivide street shapes in parts of approximately this length")
-parser.add_argument("--output", "-o", nargs=2, metavar=('ROADS-SLOPE.GEOJSON', 'BBOX.JSON'), help="Output files")
+parser.add_argument("--sample-interval", type=float, metavar='LENGTH', help="Sample the elevation every LENGTH along the segments instead of only at the end points. This adds columns climb, descent and max_grade")
+parser.add_argument("--fix-artefacts", action='store_true', help="Look for bridges and tunnels: a steep descent followed by a steep climb (or the other way around) along connected segments, and interpolate the elevation across them. This adds a column interpolated")
+parser.add_argument("--max-grade", type=float, default=0.25, metavar='SLOPE', help="With --fix-artefacts: a descent and climb steeper than this are an artefact")
+parser.add_argument("--min-grade", type=float, default=0.1, metavar='SLOPE', help="With --fix-artefacts: segments steeper than this are suspect")
+parser.add_argument("--rel-grade", type=float, default=3, metavar='FACTOR', help="With --fix-artefacts: a descent and climb this many times steeper than the road on either side are an artefact")
+parser.add_argument("--max-span", type=float, default=500, metavar='LENGTH', help="With --fix-artefacts: the longest bridge or tunnel")
+parser.add_argument("--cache", metavar='CACHE.PARQUET', help="Keep the segments of every road in this file, and only redo roads which changed, or of which the DEM tiles changed")
+parser.add_argument("--output", "-o", nargs=2, metavar=('ROADS-SLOPE.PARQUET', 'BBOX.JSON'), help="Output files. The format of the roads follows from the extension: .parquet, .feather or .geojson")
 args = parser.parse_args()
 
 
@@ -30,6 +48,7 @@ args = parser.parse_args()
 #  - geometry: LineString, preferably reasonably short ones
 #  - length: the length of the segment
 #  - slope: the slope of the segment (where 0.01 represents a 1% slope)
+#  - grade: the signed slope, positive if the segment goes up from start to end
 #  - el1: elevation at the start
 #  - el2: elevation at the end
 #
@@ -45,193 +64,209 @@ args = parser.parse_args()
 # tile grid. This is by far the largest chunk of input data.
 
 
-# load the roads, and extract columns and rows of interest
+# the roads themselves come from a road source, see roadsource.py. It picks
+# the roads we consider and adds the road_type column
 import pandas as pd
 pd.options.mode.chained_assignment = 'raise'
 
-print("Loading shapefile (patience...)", flush=True)
-roads = gpd.GeoDataFrame.from_file(args.road)
-
-# which roads to consider: only the major roads for now
-# these often have a favourable elevation profile and are often
-# where you cycle for long distances anyway
-# bicycle paths are so rare we can ignore them (sadly, and they don’t show
-# up as a distinct category in our data)
-roadClassTable = {
- 'Arterial urban'   : 'L',
- 'Arterial rural'   : 'L',
- 'Medium urban'     : 'M',
- 'Medium rural'     : 'M',
-}
-
-# generate a class column. Initially use table
-road_type = roads['CLASSIFICA'].map(roadClassTable)
-road_type = road_type.mask(road_type.isna(),           False)
-
-# insert kludges here:
-road_type = road_type.mask(roads['USE_TYPE'] == "Vehicle only",           False)
-road_type = road_type.mask(roads['ID'].isin((2165640, 1955770, 1955710)), 'L') # pretty sure that ramp is not limited access anymore
-road_type = road_type.mask(roads['PRIMARY_RO'].isin(("DAIRY FLAT HIGHWAY", "ALBANY EXPRESSWAY")), 'L') # former SH17
-road_type = road_type.mask(roads['PRIMARY_RO'].str.contains("BUSWAY", na=False), False)
-road_type = road_type.mask(roads['CLASSIFICA'] == "Motorway", False)
-
-roads2 = pd.DataFrame({'road_type': road_type})
-roads = gpd.GeoDataFrame(roads2, geometry=roads.geometry, crs=roads.crs)
-roads = roads.loc[road_type.astype(bool)].reindex()
-
 
 def round_line(l):
-    return LineString([(int(c[0]), int(c[1])) for c in l.coords])
+    """ round the coordinates of a line, or an array of lines, to integers """
+    return shapely.transform(l, np.trunc)
 
 def split_line_df(dataframe, dist_limit):
     """ splits line segments in this dataframe in place
 
     also round everything to integer"""
 
-    iloc_index = []
-    new_geometry = []
-    
-    for index, line in enumerate(dataframe.geometry):
-        splitted_line = split_line(line, dist_limit)
-        splitted_line = [round_line(l) for l in splitted_line]
-        new_geometry += splitted_line
-        iloc_index += [index] * len(splitted_line)
+    new_geometry, iloc_index = split_lines(dataframe.geometry.to_numpy(), dist_limit)
 
     dataframe = dataframe.iloc[iloc_index]
     # using in-place produces the "A value is trying to be set on a copy of a slice from a DataFrame." warning
-    return dataframe.set_geometry(new_geometry)
+    return dataframe.set_geometry(round_line(new_geometry))
 
 
 # Elevation tiles
 # ---------------
 
-tlist = []
-
-def read_sidecar(f):
-    """ guess the file name of the sidecar file and read it """
-    
-    assert f[-4] == '.'
-    # sidecar file name:
-    f = f[:-4] + '.' + f[-3] + f[-1] + 'w'
-    with open(f) as tfwf:
-        tfw = tuple(tfwf)
-        scale = float(tfw[0].strip())
-        x, y = ( float(tfw[4].strip()), float(tfw[5].strip()))
-        return x, y, scale
-
-
-# the DEM from LINZ comes in two formats: kea and tiff
-def image_files(d):
-    yield from iglob(os.path.join(d, "*.tif"))
-    yield from iglob(os.path.join(d, "*.kea"))
-
+# Only the tile headers are read here, the elevation data is read on demand
 image_f_list = list(image_files(args.dem))
 if args.test:
     image_f_list = image_f_list[700:900]
 
-for f in image_f_list:
-    with rasterio.open(f) as raster:
-        arr = raster.read(1)
-    
-        # The *.kea files don’t have any georeference data in them.
-        x, y, scale = read_sidecar(f)
-        
-        # It is actually feasible to load all those images at once.
-        # This may break down if you cover a very large area
-        size = (arr.shape[1], arr.shape[0])
-        w, h = size[0] * scale, size[1] * scale
-        bbox = BBOX(x - 0.5 * scale, y - h + 0.5 * scale, w, h)
-        tlist.append(SrcTile(bbox, f, arr, scale))
-        
-        print(end=f'{len(tlist)}/{len(image_f_list)} DEM tiles at {x:.1f}, {y:.1f}\r', flush=True)
-
-print()
-
-# These images come from a regular grid.
-# Reconstruct this grid, and create a lookup table from cell coordinate to
-# image
-
-# assume the largest of those images fills exactly one cell
-grid_w = max(t.bbox.w for t in tlist)
-grid_h = max(t.bbox.h for t in tlist)
-grid_x0 = None
-grid_y0 = None
-
-bbox_total = BBOX.with_xyxy(
-    min(t.bbox.x for t in tlist),
-    min(t.bbox.y for t in tlist),
-    max(t.bbox.x2() for t in tlist),
-    max(t.bbox.y2() for t in tlist))
-
-# the origin is a corner of a full size tile
-for t in tlist:
-    if t.bbox.w == grid_w and t.bbox.h == grid_h:
-        grid_x0 = t.bbox.x
-        grid_y0 = t.bbox.y
-        break
-
-assert grid_x0, "We are missing the grid"
-
-def tile_index(point):
-    return (int(point[0] - grid_x0) // grid_w, int(point[1] - grid_y0) // grid_h)
-
-# now, the lookup table
-tmap = {}
-for t in tlist:
-    tmap[tile_index((t.bbox.x, t.bbox.y))] = t
-
-# and the function to lookup the elevation of a point
-def elevation(p):
-    tile = tmap.get(tile_index(p), None)
-    if tile is None:
-        return None
-    px = min(tile.bbox.w - 1, max(0, p[0] - tile.bbox.x)) / tile.scale
-    py = min(tile.bbox.h - 1, max(0, p[1] - tile.bbox.y)) / tile.scale
-    h = tile.img[int(tile.bbox.h - 1 - py)][int(px)]
-    if h < -100:
-        return None
-    if h < 0:
-        return 0
-    return h
+if args.mosaic and mosaic_is_current(args.mosaic, image_f_list):
+    print("using DEM mosaic " + args.mosaic)
+else:
+    tlist = []
+    for t in read_tile_headers(image_f_list, jobs=args.jobs, index=args.tile_index):
+        tlist.append(t)
+        print(end=f'{len(tlist)}/{len(image_f_list)} DEM tiles at {t.bbox.x:.1f}, {t.bbox.y:.1f}\r', flush=True)
+
+    print()
+
+    if args.mosaic:
+        print("building DEM mosaic " + args.mosaic, flush=True)
+        build_mosaic(args.mosaic, tlist)
+
+if args.mosaic:
+    dem = MosaicStore(args.mosaic, jobs=args.jobs)
+else:
+    dem = TileStore(tlist, cache_size=args.tile_cache, jobs=args.jobs)
+bbox_total = dem.bbox_total
 
 # slopes
 # ------
 
-print("Slopes")
+def road_elevation(roads):
+    """ split roads in short segments and add the length, slope and elevation columns
+
+    The segments of a road follow each other, in the order of `roads`. Segments
+    we have no elevation data for get a NaN slope. """
+
+    # first ensure the segments are short enough. A repeated vertex, or two
+    # vertices which round to the same point, leave segments without length:
+    # these have no slope
+    roads = split_line_df(roads, args.dist_limit)
+    roads = roads.loc[roads.geometry.length.to_numpy() > 0]
+
+    # then create new data columns: start and end point
+    length = roads.geometry.length.to_numpy()
+    geoms = roads.geometry.to_numpy()
+    profile = {}
+
+    if args.sample_interval:
+        # sample the elevation profile of every segment. The first and last
+        # samples are the end points
+        xy, seg, dist = sample_points(geoms, args.sample_interval)
+        # a sample without data inside a segment shouldn’t cost us the whole segment
+        el = fill_profile_gaps(dem.elevations(xy), seg, dist)
+        count = np.bincount(seg, minlength=len(geoms))
+        last = np.cumsum(count) - 1
+        first = last - count + 1
+        el1, el2 = el[first], el[last]
+
+        # differences between consecutive samples of the same segment
+        same = seg[1:] == seg[:-1]
+        dz = np.diff(el)[same]
+        grade = np.abs(dz) / np.diff(dist)[same]
+        # every segment has at least one difference
+        dstart = first - np.arange(len(geoms))
+        climb = np.add.reduceat(np.maximum(dz, 0), dstart)
+        descent = np.add.reduceat(np.maximum(-dz, 0), dstart)
+
+        # average absolute slope, this equals the end point slope if the
+        # segment only goes up or only goes down
+        slope = (climb + descent) / length
+        profile = dict(
+            climb=np.round(climb, 1),
+            descent=np.round(descent, 1),
+            max_grade=np.round(np.maximum.reduceat(grade, dstart), 3))
+    else:
+        p1 = shapely.get_coordinates(shapely.get_point(geoms, 0))
+        p2 = shapely.get_coordinates(shapely.get_point(geoms, -1))
+
+        # ...elevation and slope. Look up both ends in one go, so each tile is read once
+        el1, el2 = np.split(dem.elevations(np.concatenate((p1, p2))), 2)
+        slope = np.abs(el2 - el1) / length
+
+    # and make dataframe
+    return roads.assign(
+        length=np.round(length, 1),
+        slope=np.round(slope, 3),
+        grade=np.round((el2 - el1) / length, 3),
+        el1=np.round(el1, 1),
+        el2=np.round(el2, 1),
+        **profile)
+
+
+CACHE_VERSION = 2
+
+def road_keys(roads):
+    """ a key per road which changes if anything changes that affects its segments:
+    its geometry, our settings, or the DEM tiles it overlaps """
+    geoms = roads.geometry.to_numpy()
+    # segment end points are rounded, so they can move a bit outside the road
+    stamps = dem.stamps(shapely.bounds(geoms) + [-1, -1, 1, 1])
+    # the version goes up when the cached columns change
+    settings = f'{CACHE_VERSION}/{args.dist_limit}/{args.sample_interval}'.encode()
+    return [hashlib.sha1(w + s.encode() + settings).hexdigest()
+            for w, s in zip(shapely.to_wkb(geoms), stamps)]
+
+
+def road_elevation_cached(roads, cache_file):
+    """ `road_elevation` which reuses the segments of roads which haven’t changed
+
+    The segments of all roads are written to `cache_file` for the next run. """
+    roads = roads.assign(cache_key=road_keys(roads), road_order=np.arange(len(roads)))
+
+    cached = None
+    if os.path.exists(cache_file):
+        cached = read_roads(cache_file)
+        cached = cached.loc[cached['cache_key'].isin(set(roads['cache_key']))]
+    todo = ~roads['cache_key'].isin(set(cached['cache_key'])) if cached is not None else np.ones(len(roads), dtype=bool)
+    print(f"{np.count_nonzero(~todo)} roads from cache, {np.count_nonzero(todo)} to update")
+
+    new = road_elevation(roads.loc[todo])
+    new = new.assign(part=new.groupby('road_order').cumcount())
+    # a cache from an older version has other keys, and maybe other columns
+    if cached is not None and len(cached):
+        # roads with the same geometry share their segments
+        reused = cached.drop(columns=['road_type', 'road_order'], errors='ignore').merge(
+            pd.DataFrame(roads.loc[~todo, ['cache_key', 'road_type', 'road_order']]), on='cache_key')
+        new = pd.concat([new, reused[new.columns]])
+    roads = new.sort_values(['road_order', 'part'], kind='stable')
+
+    first = roads['road_order'] == roads.groupby('cache_key')['road_order'].transform('min')
+    write_roads(roads.loc[first].drop(columns=['road_type', 'road_order']), cache_file)
+    return roads.drop(columns=['cache_key', 'road_order', 'part'])
+
+
+def road_artefacts(roads):
+    """ interpolate the elevation across bridges and tunnels, see artefacts.py
+
+    Segments which changed are treated as straight, and get an interpolated
+    column which is True """
+    geoms = roads.geometry.to_numpy()
+    p1 = shapely.get_coordinates(shapely.get_point(geoms, 0))
+    p2 = shapely.get_coordinates(shapely.get_point(geoms, -1))
+    length = roads['length'].to_numpy()
+    el1, el2, fixed = fix_artefacts(p1, p2, length,
+        roads['el1'].to_numpy(), roads['el2'].to_numpy(), args.max_grade, args.max_span, args.min_grade, args.rel_grade)
+    print(f"{np.count_nonzero(fixed)} segments interpolated")
+
+    dz = el2 - el1
+    columns = dict(el1=np.round(el1, 1), el2=np.round(el2, 1), slope=np.round(np.abs(dz) / length, 3), grade=np.round(dz / length, 3))
+    if 'climb' in roads:
+        columns.update(climb=np.round(np.maximum(dz, 0), 1), descent=np.round(np.maximum(-dz, 0), 1), max_grade=columns['slope'])
+    return roads.assign(
+        **{k: np.where(fixed, v, roads[k]) for k, v in columns.items()},
+        interpolated=fixed)
+
+
+print("Loading roads", flush=True)
+roads = road_source(args.road, args.osm_classes, args.crs, args.osm_index).read(bbox_total.xyxy() if args.clip else None)
 
-# first ensure the segments are short enough
-roads = split_line_df(roads, args.dist_limit)
+print("Slopes")
 
-# then create new data columns: start and end point
-length = roads.geometry.length.to_numpy()
-p1 = roads.geometry.map(lambda x : x.coords[0])
-p2 = roads.geometry.map(lambda x : x.coords[-1])
+if args.cache:
+    roads = road_elevation_cached(roads, args.cache)
+else:
+    roads = road_elevation(roads)
+print(f"{dem.loads} DEM tile loads, {dem.evictions} evictions")
 
-# ...elevation and slope
-el1 = p1.map(elevation).to_numpy()
-el2 = p2.map(elevation).to_numpy()
-slope = np.abs(el2 - el1) / length
+if args.fix_artefacts:
+    roads = road_artefacts(roads)
 
-# and make dataframe
-roads = roads.assign(
-    length=np.round(length, 1),
-    slope=np.round(slope, 3),
-    el1=np.round(el1, 1),
-    el2=np.round(el2, 1))
-roads = roads.loc[np.isfinite(slope)]
+roads = roads.loc[np.isfinite(roads['slope'])]
 
 
 # test
 def debug_inspect_height(ax):
     """ Plot elevation as a raster image """
-    X = list(range(int(bbox_total.x), int(bbox_total.x2()), 10))
-    Y = list(range(int(bbox_total.y), int(bbox_total.y2()), 10))
-    Y.reverse()
-    Z = np.zeros((len(Y), len(X)))
-
-    for ix, x in enumerate(X):
-        for iy, y in enumerate(Y):
-            Z[iy][ix] = elevation((x, y))
+    X = np.arange(int(bbox_total.x), int(bbox_total.x2()), 10)
+    Y = np.arange(int(bbox_total.y), int(bbox_total.y2()), 10)[::-1]
+    XX, YY = np.meshgrid(X, Y)
+    Z = dem.elevations(np.stack((XX.ravel(), YY.ravel()), axis=1)).reshape(XX.shape)
     dxdZ, dydZ = np.gradient(Z)
     shade = (dxdZ + dydZ) * .2 + .5
     ax.imshow(shade, extent=bbox_total.xxyy())
@@ -249,7 +284,7 @@ if args.test:
     debug_show_roads(ax)
     plt.show()
 else:
-    roads.to_file(args.output[0], driver='GeoJSON')
+    write_roads(roads, args.output[0])
     print('written to ' + args.output[0])
     open(args.output[1], "wt").write(json.dumps(bbox_total))
     print("written " + args.output[1])
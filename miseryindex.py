@@ -1,155 +1,275 @@
 import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import configparser
+import csv
+from glob import glob
+from itertools import repeat
 import json
+import os
 
 import numpy as np
 np.set_printoptions(precision=4)
 
-import matplotlib.pyplot as plt
-plt.style.use('seaborn-white')
-plt.style.use('common.mplstyle')
+from mitable import *
 
-parser = argparse.ArgumentParser(description="Calculate misery index in terms of slope.")
-parser.add_argument("profile", metavar='PROFILE.INI', help="File containing our assumptions", default='bike.ini')
-parser.add_argument("--graph", metavar='SLOPE', help="Make a plot for a given slope, write no output. Slope is given as a percentage", type=float)
-parser.add_argument("--power", action='store_true', help="Plot power instead of required traction force")
-parser.add_argument("-o", "--output", metavar='DATA.json', help="Set output file", default='misery-index.json')
-args = parser.parse_args()
+"""
+Calculate the misery index in terms of slope, for one or more rider profiles.
 
-config = configparser.ConfigParser()
-config.read(args.profile, encoding='utf-8')
-cfg_main = config['main']
+A profile describes the bicycle and the rider. Profiles come from ini files
+(see bike.ini), or from a CSV file with one profile per row and the same keys
+as column names: name, m, Crr, half-rho-cd-a2, walk-penalty and ride-profile,
+where ride-profile is a list of speed:power pairs, like `8:180 15:170 25:140`.
+"""
 
-ride_v_table = []
-ride_P_table = []
+G = 9.81
 
-for k, v in config['ride-profile'].items():
-    ride_v_table.append(float(k))
-    ride_P_table.append(float(v))
+Profile = namedtuple('Profile', 'name M Crr half_rho_cd_a2 walk_penalty ride_v_table ride_P_table')
 
-# ensure v/P curve intersects 0
-ride_v_table.append(ride_v_table[-1] + 0.1)
-ride_P_table.append(-0.01)
+# speeds we consider, and the power the rider is willing to deliver at those speeds
+Curves = namedtuple('Curves', 'v v_walk pwr_walk v_ride pwr_ride pwr_intersect ride_v_min')
 
-M = float(cfg_main['m'])
-Crr = float(cfg_main['Crr'])
-half_rho_cd_a2 = float(cfg_main['half-rho-cd-a2'])
-G = 9.81
 
-def cycling_power(speed, slope, wind):
+def make_profile(name, cfg, ride_profile):
+    """ make a profile from a mapping with the [main] keys, and (speed, power) pairs """
+    ride_v_table = []
+    ride_P_table = []
+
+    for k, v in ride_profile:
+        ride_v_table.append(float(k))
+        ride_P_table.append(float(v))
+
+    return Profile(
+        name=name,
+        M=float(cfg['m']),
+        Crr=float(cfg['crr']),
+        half_rho_cd_a2=float(cfg['half-rho-cd-a2']),
+        walk_penalty=float(cfg['walk-penalty']),
+        ride_v_table=tuple(ride_v_table),
+        ride_P_table=tuple(ride_P_table))
+
+
+def read_profile(f):
+    """ read a profile.ini file, the profile is named after the file """
+    config = configparser.ConfigParser()
+    config.read(f, encoding='utf-8')
+    return make_profile(f, config['main'], config['ride-profile'].items())
+
+
+def read_profile_csv(f):
+    """ read a CSV file with one profile per row """
+    with open(f, newline='', encoding='utf-8') as csvf:
+        for row in csv.DictReader(csvf):
+            row = {k.strip().lower(): v for k, v in row.items()}
+            pairs = [pair.split(':') for pair in row['ride-profile'].split()]
+            yield make_profile(row['name'], row, pairs)
+
+
+def find_profiles(paths):
+    """ all profiles in a list of ini files, CSV files, directories or glob patterns """
+    for p in paths:
+        if os.path.isdir(p):
+            files = sorted(glob(os.path.join(p, '*.ini')))
+        else:
+            files = sorted(glob(p)) or [p]
+        for f in files:
+            if f.lower().endswith('.csv'):
+                yield from read_profile_csv(f)
+            else:
+                yield read_profile(f)
+
+
+def cycling_power(profile, speed, slope, wind):
     """ how much power do we need in this situation
-    
+
     speed: cycling speed
     slope: positive number is uphill, eg. 0.02 for a 2% slope
     wind: positive number for headwind
-    
+
     All speeds in km/h
-    
+
     Returns power in watts"""
     v = speed / 3.6
     vRel = (speed + wind) / 3.6
-    p = M * G * (Crr + slope) * v + \
-            half_rho_cd_a2 * vRel * abs(vRel) * v
+    p = profile.M * G * (profile.Crr + slope) * v + \
+            profile.half_rho_cd_a2 * vRel * abs(vRel) * v
     return np.maximum(p, 0)
 
-v = np.arange(0.1, ride_v_table[-1] + 0.101, 0.1)
 
-# walking profile
-v_walk = np.arange(2, 6, 0.1)
-pwr_walk = np.interp(v_walk, [2, 6], [140, 10])
-walk_penalty = float(cfg_main['walk-penalty'])
+def rider_curves(profile):
+    """ the power the rider is willing to deliver, riding or walking """
+
+    # ensure v/P curve intersects 0
+    ride_v_table = profile.ride_v_table + (profile.ride_v_table[-1] + 0.1,)
+    ride_P_table = profile.ride_P_table + (-0.01,)
+
+    v = np.arange(0.1, ride_v_table[-1] + 0.101, 0.1)
+
+    # walking profile
+    v_walk = np.arange(2, 6, 0.1)
+    pwr_walk = np.interp(v_walk, [2, 6], [140, 10])
 
-v_ride = np.arange(ride_v_table[0], ride_v_table[-1] + 0.101, 0.1)
-pwr_ride = np.interp(v_ride, ride_v_table, ride_P_table)
+    v_ride = np.arange(ride_v_table[0], ride_v_table[-1] + 0.101, 0.1)
+    pwr_ride = np.interp(v_ride, ride_v_table, ride_P_table)
 
-pwr_intersect = np.maximum(
-    np.interp(v, v_ride, pwr_ride, left=0),
-    np.interp(v, v_walk, pwr_walk, right=0))
+    pwr_intersect = np.maximum(
+        np.interp(v, v_ride, pwr_ride, left=0),
+        np.interp(v, v_walk, pwr_walk, right=0))
 
-pwr_baseline = cycling_power(v, 0, 0)
+    return Curves(v, v_walk, pwr_walk, v_ride, pwr_ride, pwr_intersect, ride_v_table[0])
 
-def calc_power_use(slope, show_plot=False):
 
-    wind =  np.arange(-20, 20.1, 10) if args.graph is not None else np.arange(-25, 25.1, 5)
-    p_corr = 1 if args.power else 1 / v
+def calc_power_use(profile, slopes, wind, curves=None):
+    """ where do the rider and the required power meet
 
-    pwr = [ cycling_power(v, -slope, w) for w in wind ] +\
-          [ cycling_power(v,  slope, w) for w in wind ]
-    
-    # intersection points
-    p_speed = np.empty([2 * len(wind)])
-    p_power = np.empty([2 * len(wind)])
-    p_speed[:] = np.nan
-    p_power[:] = np.nan
+    slopes: array of slopes, every slope is ridden downhill and uphill
+    wind: array of wind speeds, every slope is ridden with each of these
 
-    for i, p in enumerate(pwr):
-        idx = np.nonzero(np.diff(np.sign(pwr_intersect - p)))[0]
-        j = idx[-1]
-        p_speed[i] = v[j]
-        p_power[i] = p[j] + walk_penalty * v[j] * (v[j] < ride_v_table[0])
+    Everything is evaluated as one (slope, wind, speed) array.
+
+    Returns (avg, p_speed, p_power, pwr): the average energy use per slope, speed and
+    power at the intersection points with shape (slopes, 2 × wind), and the power
+    curves with shape (slopes, 2 × wind, speed). Downhill comes first. """
+    if curves is None:
+        curves = rider_curves(profile)
+    v = curves.v
+
+    slopes = np.asarray(slopes, dtype=float)
+    signed = np.concatenate((
+        np.repeat(-slopes[:, None], len(wind), axis=1),
+        np.repeat( slopes[:, None], len(wind), axis=1)), axis=1)
+    pwr = cycling_power(profile, v, signed[:, :, None], np.concatenate((wind, wind))[:, None])
+
+    # intersection points: the last speed where the curves cross.
+    # The v/P curve intersects 0 so there is always one
+    crossing = np.diff(np.sign(curves.pwr_intersect - pwr), axis=-1) != 0
+    j = crossing.shape[-1] - 1 - np.argmax(crossing[..., ::-1], axis=-1)
+    p_speed = v[j]
+    p_power = np.take_along_axis(pwr, j[..., None], axis=-1)[..., 0] + \
+        profile.walk_penalty * p_speed * (p_speed < curves.ride_v_min)
 
     energy = p_power / p_speed
-    avg = np.average(energy)
-
-    if show_plot:
-        fig, ax = plt.subplots(figsize=[6, 4])
-        
-        # print table
-        for pv, pp, pe, w in zip(p_speed, p_power, energy, np.concatenate((wind, wind))):
-            print(f'wind: {w:3.0f}km/h | {pv:4.1f}km/h  {pp:4.1f}W  {pe:5.2f}Wh/km')
-        print()
-        print(f'Average: {avg:5.2f}Wh/km')
-
-        # reference: light gray
-        ax.plot(v, pwr_baseline * p_corr, '--', color=(.8, .8, .8))
-
-        for pp, w in zip(pwr, np.concatenate((wind, wind))):
-            # tailwind: blue
-            if w < 0:   
-                c = (.2, .4, 1)
-            elif w > 0:
-                # headwind: red
-                c = (.8, .2, .3)
-            else:
-                # still: yellow
-                c = (.7, .6, 0)
-            ax.plot(v, pp * p_corr, color=c)
-
-        # ref: green
-        ax.plot(v_walk, pwr_walk * (1 if args.power else 1/v_walk), '--', color=(0.0, 0.6, 0.2))
-        ax.plot(v_ride, pwr_ride * (1 if args.power else 1/v_ride), '--', color=(0.0, 0.6, 0.2))
-
-        # intersections
-        i_corr = 1 if args.power else 1 / p_speed
-        ax.scatter(p_speed, p_power * i_corr, 9, color=(.1, .1, .1))
-
-        ax.grid(True)
-        ax.set_title(f'slope: {slope*100:.0f}%')
-        if args.power:
-            ax.set_ylim([-3, 145])
-            ax.set_ylabel('Power (W)')
+    avg = np.average(energy, axis=-1)
+    return avg, p_speed, p_power, pwr
+
+
+def misery_table(profile, slopes, wind):
+    """ misery index and energy use for an array of slopes, starting at 0
+
+    Returns (mi, pwr, mi_up, mi_down): the misery index and energy use averaged
+    over both directions, and the misery index riding up and riding down the
+    slope. The reference is always the average energy use on the flat. """
+    pwr, p_speed, p_power, _ = calc_power_use(profile, slopes, wind)
+    energy = p_power / p_speed
+    # downhill comes first
+    down, up = np.split(energy, 2, axis=-1)
+    return pwr/pwr[0] - 1, pwr, np.average(up, axis=-1)/pwr[0] - 1, np.average(down, axis=-1)/pwr[0] - 1
+
+
+def plot_power_use(profile, slope, power=False):
+    """ print the intersection points for one slope, and plot the curves """
+
+    # only import matplotlib when we make a plot
+    import matplotlib.pyplot as plt
+    plt.style.use('seaborn-white')
+    plt.style.use('common.mplstyle')
+
+    curves = rider_curves(profile)
+    v = curves.v
+    wind = np.arange(-20, 20.1, 10)
+    p_corr = 1 if power else 1 / v
+
+    avg, p_speed, p_power, pwr = (x[0] for x in calc_power_use(profile, [slope], wind, curves))
+    energy = p_power / p_speed
+
+    fig, ax = plt.subplots(figsize=[6, 4])
+
+    # print table
+    print(profile.name)
+    for pv, pp, pe, w in zip(p_speed, p_power, energy, np.concatenate((wind, wind))):
+        print(f'wind: {w:3.0f}km/h | {pv:4.1f}km/h  {pp:4.1f}W  {pe:5.2f}Wh/km')
+    print()
+    print(f'Average: {avg:5.2f}Wh/km')
+
+    # reference: light gray
+    ax.plot(v, cycling_power(profile, v, 0, 0) * p_corr, '--', color=(.8, .8, .8))
+
+    for pp, w in zip(pwr, np.concatenate((wind, wind))):
+        # tailwind: blue
+        if w < 0:
+            c = (.2, .4, 1)
+        elif w > 0:
+            # headwind: red
+            c = (.8, .2, .3)
         else:
-            ax.set_ylim([-2, max(30, 1+np.max(energy))])
-            ax.set_ylabel('Energy use (Wh/km)')
-
-        ax.set_xlabel('Speed (km/h)')
-        plt.show()
-
-    return avg
-
-mi_list = []
-pwr_0 = None
-
-if args.graph is not None:
-    calc_power_use(args.graph * .01, show_plot=True)
-else:
-    for sl in np.arange(0, 0.25001, 0.005):
-        pwr = calc_power_use(sl, show_plot=False)
-        if sl == 0:
-            pwr_0 = pwr
-        mi = pwr/pwr_0 - 1
-        mi_list.append(dict(slope=sl, mi=mi, p=pwr))
-        print(f"misery index for {100*sl:4.1f}%: {mi:4.1f}  ({pwr:.2f})")
-
-    f = open(args.output, 'wt')
-    json.dump(mi_list, f)
+            # still: yellow
+            c = (.7, .6, 0)
+        ax.plot(v, pp * p_corr, color=c)
+
+    # ref: green
+    ax.plot(curves.v_walk, curves.pwr_walk * (1 if power else 1/curves.v_walk), '--', color=(0.0, 0.6, 0.2))
+    ax.plot(curves.v_ride, curves.pwr_ride * (1 if power else 1/curves.v_ride), '--', color=(0.0, 0.6, 0.2))
+
+    # intersections
+    i_corr = 1 if power else 1 / p_speed
+    ax.scatter(p_speed, p_power * i_corr, 9, color=(.1, .1, .1))
+
+    ax.grid(True)
+    ax.set_title(f'{profile.name}, slope: {slope*100:.0f}%')
+    if power:
+        ax.set_ylim([-3, 145])
+        ax.set_ylabel('Power (W)')
+    else:
+        ax.set_ylim([-2, max(30, 1+np.max(energy))])
+        ax.set_ylabel('Energy use (Wh/km)')
+
+    ax.set_xlabel('Speed (km/h)')
+    plt.show()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calculate misery index in terms of slope.")
+    parser.add_argument("profile", metavar='PROFILE.INI', nargs='*', help="File containing our assumptions, bike.ini by default. Several files, directories, glob patterns or CSV files with one profile per row make a batch", default=['bike.ini'])
+    parser.add_argument("--graph", metavar='SLOPE', help="Make a plot for a given slope, write no output. Slope is given as a percentage. With several profiles, every profile gets a plot", type=float)
+    parser.add_argument("--power", action='store_true', help="Plot power instead of required traction force")
+    parser.add_argument("--slope-step", metavar='PERCENT', help="Step between slopes in the table", type=float, default=0.5)
+    parser.add_argument("--max-slope", metavar='PERCENT', help="Largest slope in the table", type=float, default=25)
+    parser.add_argument("--wind-step", metavar='KM/H', help="Step between wind speeds we average over, from -25 to 25km/h", type=float, default=5)
+    parser.add_argument("--jobs", "-j", type=int, default=1, metavar='N', help="Calculate a batch of profiles in N processes")
+    parser.add_argument("-o", "--output", metavar='DATA.json', help="Set output file. A .npz file gets a binary table with a row per profile (see mitable.py), a batch of profiles needs one", default='misery-index.json')
+    args = parser.parse_args()
+
+    profiles = list(find_profiles(args.profile))
+    binary = args.output.lower().endswith('.npz')
+    if not profiles:
+        parser.error("no profiles found")
+    if len(profiles) > 1 and not binary and args.graph is None:
+        parser.error("a batch of profiles must be written to a .npz file")
+
+    if args.graph is not None:
+        for p in profiles:
+            plot_power_use(p, args.graph * .01, args.power)
+    else:
+        # the table starts at 0, which is our reference
+        slopes = np.arange(0, args.max_slope * .01 + 1e-5, args.slope_step * .01)
+        wind = np.arange(-25, 25.1, args.wind_step)
+
+        if args.jobs > 1 and len(profiles) > 1:
+            with ProcessPoolExecutor(args.jobs) as pool:
+                tables = list(pool.map(misery_table, profiles, repeat(slopes), repeat(wind), chunksize=16))
+        else:
+            tables = [misery_table(p, slopes, wind) for p in profiles]
+
+        if binary:
+            # one row per profile
+            write_tables(args.output, profiles, slopes, tables)
+            print(f"written {len(profiles)} profiles to {args.output}")
+        else:
+            mi, pwr, mi_up, mi_down = tables[0]
+            mi_list = []
+            for sl, m, p, mu, md in zip(slopes, mi, pwr, mi_up, mi_down):
+                mi_list.append(dict(slope=sl, mi=m, p=p, mi_up=mu, mi_down=md))
+                print(f"misery index for {100*sl:4.1f}%: {m:4.1f}  ({p:.2f})  up: {mu:4.1f}  down: {md:4.1f}")
+
+            f = open(args.output, 'wt')
+            json.dump(mi_list, f)
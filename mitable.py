@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+"""
+The misery index table, as written by miseryindex.py.
+
+The binary form is a .npz file with one row per profile:
+
+ - start, step: the table has a value for every slope start + k × step
+ - slope: those slopes
+ - profile: the names of the profiles
+ - mi, p, mi_up, mi_down: the tables (profiles × slopes), float32
+ - M, Crr, half_rho_cd_a2, walk_penalty: the profiles themselves
+
+Because the slopes are evenly spaced, looking up a slope is a matter of
+arithmetic, we don’t need to search the table.
+"""
+
+TABLE_COLUMNS = ('mi', 'p', 'mi_up', 'mi_down')
+
+
+def write_tables(f, profiles, slopes, tables):
+    """ write the tables of a list of profiles, `tables` has (mi, p, mi_up, mi_down) per profile """
+    slopes = np.asarray(slopes, dtype=float)
+    np.savez_compressed(f,
+        start=slopes[0],
+        step=slopes[1] - slopes[0] if len(slopes) > 1 else 1.,
+        slope=slopes,
+        profile=np.array([p.name for p in profiles]),
+        **{c: np.array([t[k] for t in tables], dtype=np.float32) for k, c in enumerate(TABLE_COLUMNS)},
+        M=np.array([p.M for p in profiles]),
+        Crr=np.array([p.Crr for p in profiles]),
+        half_rho_cd_a2=np.array([p.half_rho_cd_a2 for p in profiles]),
+        walk_penalty=np.array([p.walk_penalty for p in profiles]))
+
+
+class MiseryTable:
+    """ the misery index of one profile, for evenly spaced slopes
+
+    Slopes outside the table get the value at its nearest end, like `np.interp`.
+    NaN or infinite slopes get NaN. """
+
+    def __init__(self, start, step, columns, name=None):
+        self.start = float(start)
+        self.step = float(step)
+        self.columns = columns
+        self.name = name
+
+    def _position(self, slope):
+        """ index of the table entry below every slope, and how far we are towards the next one
+
+        For slopes which aren’t finite that is NaN, so they interpolate to NaN """
+        n = len(next(iter(self.columns.values())))
+        x = (np.asarray(slope, dtype=float) - self.start) / self.step
+        finite = np.isfinite(x)
+        x = np.where(finite, x, 0)
+        i = np.clip(np.floor(x), 0, max(n - 2, 0)).astype(np.intp)
+        t = np.clip(x - i, 0, 1) if n > 1 else np.zeros_like(x)
+        return i, np.where(finite, t, np.nan)
+
+    def _gather(self, column, i, t):
+        v = self.columns[column]
+        return v[i] + t * (v[np.minimum(i + 1, len(v) - 1)] - v[i])
+
+    def digest(self):
+        """ a hash of the table, which changes if any value changes """
+        h = hashlib.sha1(np.array([self.start, self.step]).tobytes())
+        for c in sorted(self.columns):
+            h.update(c.encode())
+            h.update(np.ascontiguousarray(self.columns[c], dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def lookup(self, slope, column='mi'):
+        """ interpolate a column of the table for an array of slopes """
+        return self._gather(column, *self._position(slope))
+
+    def lookup_signed(self, grade):
+        """ the misery index for an array of signed slopes: riding up for
+        positive, riding down for negative ones """
+        if 'mi_up' not in self.columns:
+            raise KeyError("this misery index table has no mi_up and mi_down, make it again with miseryindex.py")
+        grade = np.asarray(grade, dtype=float)
+        i, t = self._position(np.abs(grade))
+        return np.where(grade >= 0, self._gather('mi_up', i, t), self._gather('mi_down', i, t))
+
+
+def read_misery_table(f, profile=None):
+    """ read a misery index table: a .npz file, or the JSON file miseryindex.py
+    writes for a single profile
+
+    profile: the name of the profile to use from a .npz file, or the first one """
+    if os.path.splitext(f)[1].lower() == '.npz':
+        with np.load(f) as data:
+            names = list(data['profile'])
+            if profile is None:
+                k = 0
+            elif profile in names:
+                k = names.index(profile)
+            else:
+                raise KeyError(f"no profile {profile} in {f}")
+            columns = {c: data[c][k] for c in TABLE_COLUMNS if c in data}
+            return MiseryTable(data['start'], data['step'], columns, names[k])
+
+    with open(f) as jsonf:
+        rows = json.load(jsonf)
+    slopes = np.array([r['slope'] for r in rows])
+    step = (slopes[-1] - slopes[0]) / (len(slopes) - 1) if len(slopes) > 1 else 1.
+    assert np.allclose(np.diff(slopes), step), f"the slopes in {f} aren’t evenly spaced"
+    columns = {c: np.array([r[c] for r in rows]) for c in TABLE_COLUMNS if c in rows[0]}
+    return MiseryTable(slopes[0], step, columns, f)
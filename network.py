@@ -0,0 +1,126 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+"""
+Misery index along the road network.
+
+Instead of blurring the image, which also mixes in roads across a harbour or
+a motorway, we can look at the roads you can reach within some distance along
+the road network. The segments are the edges of a graph, their (rounded) end
+points are the nodes. Distances come from Dijkstra’s algorithm in
+`scipy.sparse.csgraph`, which stops at the distance we are interested in.
+"""
+
+
+def road_graph(p1, p2, length):
+    """ build a graph from segments with start and end points p1, p2 (shape (n, 2))
+
+    End points which are exactly equal are the same node. Returns (nodes, a, b, graph):
+    the node coordinates, the nodes at the start and end of every segment, and
+    a sparse matrix with the length of the shortest segment between two nodes """
+    n = len(p1)
+    nodes, inverse = np.unique(np.concatenate((p1, p2)), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    a, b = inverse[:n], inverse[n:]
+
+    # a sparse matrix adds up duplicate entries, so only keep the shortest
+    # segment between two nodes. An explicit 0 would mean there is no edge
+    i, j = np.minimum(a, b), np.maximum(a, b)
+    w = np.maximum(length, 1e-3)
+    order = np.lexsort((w, j, i))
+    i, j, w = i[order], j[order], w[order]
+    first = np.ones(n, dtype=bool)
+    first[1:] = (i[1:] != i[:-1]) | (j[1:] != j[:-1])
+    keep = first & (i != j)
+    graph = csr_matrix((w[keep], (i[keep], j[keep])), shape=(len(nodes), len(nodes)))
+    return nodes, a, b, graph
+
+
+# what the workers need, set once per process by `_init`
+_state = {}
+
+def _init(nodes, graph, a, b, length, values, limit):
+    from scipy.spatial import cKDTree
+
+    # the segments at every node: incident[start[k]:start[k + 1]] for node k
+    ends = np.concatenate((a, b))
+    order = np.argsort(ends, kind='stable')
+    _state.update(nodes=nodes, tree=cKDTree(nodes), graph=graph, a=a, b=b, length=length, values=values, limit=limit,
+        incident=order % len(a), start=np.searchsorted(ends[order], np.arange(len(nodes) + 1)))
+
+
+def _reach(sources):
+    """ sum the length and `values` of all segments within the limit of every
+    source node. A segment counts if its middle is close enough
+
+    Nothing further than the limit along the network is further than the limit
+    as the crow flies, so Dijkstra only needs the part of the graph in a box
+    around the sources, and its distance matrix is (sources × nodes in the box) """
+    s = _state
+    limit = s['limit']
+    lo, hi = s['nodes'][sources].min(axis=0), s['nodes'][sources].max(axis=0)
+    local = np.sort(np.array(s['tree'].query_ball_point((lo + hi) / 2, (hi - lo).max() / 2 + limit, p=np.inf), dtype=int))
+    dist = dijkstra(s['graph'][local][:, local], directed=False, indices=np.searchsorted(local, sources), limit=limit)
+
+    # the segments at these nodes, their other end can be outside the box
+    count = s['start'][local + 1] - s['start'][local]
+    k = np.repeat(s['start'][local] - np.cumsum(count) + count, count) + np.arange(count.sum())
+    seg = np.unique(s['incident'][k])
+
+    def node_dist(node):
+        pos = np.minimum(np.searchsorted(local, node), len(local) - 1)
+        return np.where(local[pos] == node, dist[:, pos], np.inf)
+
+    length = s['length'][seg]
+    within = (np.minimum(node_dist(s['a'][seg]), node_dist(s['b'][seg])) + length * .5) <= limit
+    return within @ s['values'][seg], within @ length
+
+
+def _batches(points, limit, batch):
+    """ split source nodes in batches of at most `batch`, each within one square
+    of size `limit`. Returns a list of index arrays """
+    cell = np.floor(points / limit).astype(np.int64)
+    order = np.lexsort((cell[:, 0], cell[:, 1]))
+    cell = cell[order]
+    new_cell = np.ones(len(order), dtype=bool)
+    new_cell[1:] = np.any(cell[1:] != cell[:-1], axis=1)
+    # position within its square
+    group = np.cumsum(new_cell) - 1
+    k = np.arange(len(order)) - np.flatnonzero(new_cell)[group]
+    split = np.flatnonzero(new_cell | (k % batch == 0))
+    return np.split(order, split[1:]) if len(order) else []
+
+
+def network_sums(nodes, graph, a, b, length, values, sources, limit, batch=256, jobs=1):
+    """ for every source node, sum `values` and the length of the segments within
+    a distance `limit` along the graph (see `road_graph`)
+
+    Sources are done `batch` at a time, sources close together go in the same
+    batch. Every batch needs a (batch × nodes within reach) distance matrix.
+    With `jobs` > 1 batches are spread over that many processes.
+
+    Returns (values, length), one element per source """
+    batches = _batches(nodes[sources], limit, batch)
+    initargs = (nodes, graph, a, b, length, values, limit)
+    results = []
+    def progress(r):
+        results.append(r)
+        print(end=f'{len(results)}/{len(batches)} batches\r', flush=True)
+
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs, initializer=_init, initargs=initargs) as pool:
+            for r in pool.map(_reach, [sources[k] for k in batches]):
+                progress(r)
+    else:
+        _init(*initargs)
+        for k in batches:
+            progress(_reach(sources[k]))
+    print()
+
+    mi_sum, weight = np.zeros(len(sources)), np.zeros(len(sources))
+    for k, r in zip(batches, results):
+        mi_sum[k], weight[k] = r
+    return mi_sum, weight
@@ -1,18 +1,26 @@
-import json
+import argparse
+
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 plt.style.use('seaborn-white')
 plt.style.use('common.mplstyle')
 
+from mitable import *
+
 """ this script simply plots the misery index vs. slope. """
 
-# set filename here
-mi_list = json.load(open("misery-index.json"))
+parser = argparse.ArgumentParser(description="Plot the misery index in terms of slope")
+parser.add_argument("misery_index", metavar='MISERY-INDEX.NPZ', nargs='?', default='misery-index.npz', help="Misery index table from miseryindex.py, the binary .npz table or JSON")
+parser.add_argument("--profile", metavar='NAME', help="The profile to plot from a .npz table with several profiles. By default the first one")
+parser.add_argument("--max-slope", metavar='PERCENT', type=float, default=10, help="Largest slope to plot")
+args = parser.parse_args()
+
+table = read_misery_table(args.misery_index, args.profile)
+slopes = np.arange(0, args.max_slope * .01, table.step)
 
 ax = plt.gca()
-ax.plot(
-    [x['slope'] for x in mi_list[0:20]],
-    [x['mi'] for x in mi_list[0:20]])
+ax.plot(slopes, table.lookup(slopes))
 ax.set_xlim(xmin=0)
 ax.set_ylim(ymin=0)
 ax.grid(axis='both')
@@ -5,11 +5,11 @@ import geopandas as gpd
 import json
 from math import floor
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter1d
 import os
 import re
 from math import sqrt
 import rasterio
+import shapely
 from shapely.geometry import LineString, MultiPoint, box
 from shapely.ops import split
 
@@ -17,6 +17,11 @@ import matplotlib.pyplot as plt
 from our_cm import our_cm
 
 from bbox import *
+from blur import *
+from lineops import *
+from mitable import *
+from network import *
+from roadio import *
 
 """
 This creates the raster data with the misery index.
@@ -26,94 +31,354 @@ away from home so the index should be somewhat dependent on areas up to a kilome
 """
 
 
+def pyramid_level(s):
+    """ parse FACTOR[:RADIUS] """
+    factor, _, blur = s.partition(':')
+    return int(factor), float(blur) if blur else None
+
 parser = argparse.ArgumentParser(description="Create our misery index raster.")
 parser.add_argument("--resolution", type=float, default=500, help="Size of the pixels in the output")
 parser.add_argument("--blur", type=float, default=2, metavar='RADIUS', help="Radius (standard deviation) used to blur the raster")
-parser.add_argument("slopes", metavar='ROADS-SLOPE.GEOJSON', help="File with road shapes with slope data")
+parser.add_argument("--blur-engine", choices=BLUR_ENGINES, default='scipy', help="How to blur: scipy (exact, slow for a large radius), box (three box filters, the cost doesn’t depend on the radius, but it is approximate; below a radius of 8 this uses scipy) or fft. See blur.py and blur-benchmark.py")
+parser.add_argument("--splat", choices=('line', 'centroid'), default='line', help="Spread the length of a segment over all pixels it crosses (line), or put it all in the pixel with its centroid")
+parser.add_argument("--max-slope", type=float, default=0.25, metavar='SLOPE', help="Leave out segments steeper than this, these are usually artefacts of the DEM (see make-elevation.py --fix-artefacts)")
+parser.add_argument("--network", type=float, metavar='DISTANCE', help="Instead of blurring, average the misery index over the roads within this distance along the road network from every pixel. See network.py")
+parser.add_argument("--batch", type=int, default=256, metavar='N', help="With --network: find the reachable roads for N pixels at a time")
+parser.add_argument("--jobs", "-j", type=int, default=1, metavar='N', help="With --network: use N processes")
+parser.add_argument("--direction", choices=('to-centre', 'from-centre'), help="Use the misery index for riding every road towards --centre, or away from it, instead of the average of both directions. This needs the grade column from make-elevation.py and mi_up/mi_down in the misery index table")
+parser.add_argument("--centre", type=float, nargs=2, metavar=('X', 'Y'), help="The centre for --direction")
+parser.add_argument("--tile-size", type=int, metavar='PIXELS', help="Make the raster in square tiles of this size, so large areas fit in memory. There is no preview in this mode")
+parser.add_argument("--pyramid", action='append', default=[], type=pyramid_level, metavar='FACTOR[:RADIUS]', help="Also write a coarser raster, with pixels FACTOR times larger, blurred with the given radius (in those larger pixels, by default --blur divided by FACTOR). The output file gets a suffix -xFACTOR. Can be given more than once")
+parser.add_argument("--accumulator", metavar='ACC.NPZ', help="Keep the image before blurring in this file, so it can be updated later with --previous")
+parser.add_argument("--previous", metavar='OLD-ROADS-SLOPE.PARQUET', help="Update an existing output: only the segments which differ from this older road file are added or removed, and only the area around them is written again. Needs --accumulator from an earlier run")
+parser.add_argument("slopes", metavar='ROADS-SLOPE.PARQUET', help="File with road shapes with slope data (.parquet, .feather or .geojson)")
 parser.add_argument("bbox", metavar='ROADS-BBOX.JSON', help="Bounding box")
-parser.add_argument("misery_index", metavar='MISERY-INDEX.JSON', help="Misery index table")
+parser.add_argument("misery_index", metavar='MISERY-INDEX.JSON', help="Misery index table, the JSON file or the binary .npz table from miseryindex.py")
+parser.add_argument("--profile", metavar='NAME', help="The profile to use from a .npz misery index table with several profiles. By default the first one")
 parser.add_argument("water", metavar='WATER.GEOJSON', help="Coastline shapes (actually the areas covered in water), if you want to plot them", nargs='?')
 parser.add_argument("-o", "--output", metavar='HILL-MISERY-INDEX.TIF', help="Output file (geotiff)")
-args = parser.parse_args()
 
+# --network -j starts worker processes, which import this file again (this is
+# how Windows and macOS start them). They must not run the script
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.tile_size and (args.pyramid or args.accumulator):
+        parser.error("--pyramid and --accumulator need the whole image, they can’t be combined with --tile-size")
+    if args.network and (args.tile_size or args.pyramid or args.accumulator or args.previous):
+        parser.error("--network makes the whole image in one go, it can’t be combined with --tile-size, --pyramid, --accumulator or --previous")
+    if bool(args.direction) != bool(args.centre):
+        parser.error("--direction and --centre go together")
+    if args.previous and not args.accumulator:
+        parser.error("--previous needs the --accumulator of an earlier run")
+
+
+    print("loading data", flush=True)
+
+    roads = read_roads(args.slopes)
+    if args.water:
+        water = gpd.GeoDataFrame.from_file(args.water)
+    bbox_total = BBOX(*json.load(open(args.bbox)))
+    mi_table = read_misery_table(args.misery_index, args.profile)
+
+    print("making image", flush=True)
+
+    # create our image and calculate how the pixel coordinates line up
+    # the pixels are aligned on an integer multiple of the resolution
+
+    img_xy = (floor(bbox_total.x / args.resolution) * args.resolution,
+              floor(bbox_total.y / args.resolution) * args.resolution )
+
+    def scale_pixel(x, y):
+        """ pixel coordinates of points (or arrays of points), counted from the bottom-left """
+        return (np.trunc(x - img_xy[0]) // args.resolution).astype(int), \
+               (np.trunc(y - img_xy[1]) // args.resolution).astype(int)
+
+    img_size = scale_pixel(bbox_total.x2(), bbox_total.y2())
+    img_size = (int(img_size[0]) + 1, int(img_size[1]) + 1)
+
+    bbox_img = BBOX(*img_xy, img_size[0] * args.resolution, img_size[1] * args.resolution)
+
+    def inside(px, py):
+        """ which pixel coordinates fall inside the image """
+        return (px >= 0) & (py >= 0) & (px < img_size[0]) & (py < img_size[1])
+
+    def accumulate(col, row, channels, window=None, dtype=float):
+        """ sum values into an image, one channel per array in `channels`.
+
+        Values with the same pixel coordinates add up. `window` (col, row, width, height)
+        selects a part of the image, pixels outside of it are ignored. """
+        col0, row0, w, h = window or (0, 0, img_size[0], img_size[1])
+        flat = (row - row0) * w + (col - col0)
+        return np.stack([np.bincount(flat, weights=c, minlength=w * h).reshape(h, w).astype(dtype, copy=False) for c in channels], axis=-1)
+
+    def block_sum(acc, factor):
+        """ sum blocks of factor × factor pixels of an accumulated image
+
+        Like our image, the blocks are aligned on an integer multiple of their size,
+        the image is padded as needed. Returns the new image and its bottom-left corner. """
+        resolution = args.resolution * factor
+        xy = (floor(img_xy[0] / resolution) * resolution,
+              floor(img_xy[1] / resolution) * resolution)
+        left = round((img_xy[0] - xy[0]) / args.resolution)
+        bottom = round((img_xy[1] - xy[1]) / args.resolution)
+
+        h, w = acc.shape[:2]
+        H, W = -(-(h + bottom) // factor), -(-(w + left) // factor)
+        top = H * factor - h - bottom
+        padded = np.zeros((H * factor, W * factor, acc.shape[2]), acc.dtype)
+        padded[top:top + h, left:left + w] = acc
+        return padded.reshape(H, factor, W, factor, -1).sum(axis=(1, 3)), xy
+
+    def misery_image(acc, blur=None, resolution=None):
+        """ blur the accumulated image, and divide the misery index by its weight
+
+        pixels with too low weight are discarded (NaN) """
+        if blur is None:
+            blur = args.blur
+        resolution = resolution or args.resolution
+        acc = gaussian_blur(acc, blur, args.blur_engine)
+        acc[:, :, 0] =  np.where(acc[:, :, 1] > resolution * .4, acc[:, :, 0], np.nan)
+        return acc[:, :, 0] / acc[:, :, 1]
+
+    # for every road segment, convert slope to misery index,
+    # and splat on image. The image has two channels: misery index and pixel weight
+
+    if args.direction and 'mi_up' not in mi_table.columns:
+        raise SystemExit("--direction needs a misery index table with mi_up and mi_down, make it again with miseryindex.py")
+
+    def segment_mi(roads):
+        """ the misery index of every segment
+
+        With --direction this is the misery index for riding the segment towards
+        (or away from) the centre, otherwise the average of both directions """
+        if not args.direction:
+            return mi_table.lookup(roads["slope"].to_numpy())
+
+        if 'grade' not in roads:
+            raise SystemExit("--direction needs the grade column, make the road file again with make-elevation.py")
+        geoms = roads.geometry.to_numpy()
+        d1 = shapely.distance(shapely.get_point(geoms, 0), shapely.Point(args.centre))
+        d2 = shapely.distance(shapely.get_point(geoms, -1), shapely.Point(args.centre))
+        # the grade is for riding from start to end
+        forward = (d2 < d1) == (args.direction == 'to-centre')
+        grade = np.where(forward, 1, -1) * roads["grade"].to_numpy()
+        return mi_table.lookup_signed(grade)
+
+    def contributions(roads):
+        """ what a set of road segments adds to the image
+
+        Returns pixel coordinates (col, row) and the values of both channels """
+        length = roads.geometry.length.to_numpy()
+        slope = roads["slope"].to_numpy()
+        mi = segment_mi(roads)
+
+        if args.splat == 'line':
+            # every pixel gets the length of the segment which falls inside it
+            px, py, weight, seg = grid_lengths(roads.geometry.to_numpy(), img_xy, args.resolution)
+        else:
+            # the whole segment goes to the pixel with its centroid
+            centroid = roads.geometry.centroid
+            px, py = scale_pixel(centroid.x.to_numpy(), centroid.y.to_numpy())
+            weight = length
+            seg = np.arange(len(roads))
+
+        # very high slopes are usually artefacts of the DEM following
+        # the slope under a bridge
+        keep = inside(px, py) & (slope[seg] <= args.max_slope)
+        px, py, weight, seg = px[keep], py[keep], weight[keep], seg[keep]
+        return px, img_size[1] - 1 - py, (mi[seg] * weight, weight)
+
+    def network_image(roads):
+        """ the misery index of the roads within `args.network` along the road
+        network, for the node nearest to every pixel centre
+
+        Pixels without a node within one pixel size are discarded (NaN) """
+        from scipy.spatial import cKDTree
+
+        slope = roads["slope"].to_numpy()
+        roads = roads.loc[slope <= args.max_slope]
+        geoms = roads.geometry.to_numpy()
+        length = shapely.length(geoms)
+        mi = segment_mi(roads)
+
+        # end points are snapped to whole metres, like make-elevation.py does
+        p1 = np.trunc(shapely.get_coordinates(shapely.get_point(geoms, 0)))
+        p2 = np.trunc(shapely.get_coordinates(shapely.get_point(geoms, -1)))
+        nodes, a, b, graph = road_graph(p1, p2, length)
+        print(f"{len(nodes)} nodes, {graph.nnz} edges", flush=True)
+
+        col, row = np.meshgrid(np.arange(img_size[0]), np.arange(img_size[1]))
+        centres = np.stack((img_xy[0] + (col.ravel() + .5) * args.resolution,
+                            img_xy[1] + (img_size[1] - row.ravel() - .5) * args.resolution), axis=1)
+        _, nearest = cKDTree(nodes).query(centres, distance_upper_bound=args.resolution)
+        found = nearest < len(nodes)
+
+        # pixels which share their nearest node share the result
+        sources, inverse = np.unique(nearest[found], return_inverse=True)
+        mi_sum, weight = network_sums(nodes, graph, a, b, length, mi * length, sources, args.network, args.batch, args.jobs)
+
+        img = np.full(img_size[0] * img_size[1], np.nan, dtype=np.float32)
+        enough = weight[inverse] > args.resolution * .4
+        img[np.flatnonzero(found)[enough]] = (mi_sum[inverse] / np.maximum(weight[inverse], 1e-9))[enough]
+        return img.reshape(img_size[1], img_size[0])
+
+    def segment_keys(roads):
+        """ a key per segment, made of its geometry and slope, and with --direction
+        its grade. Duplicate segments get a counter, so the keys are unique """
+        keys = pd.Series(shapely.to_wkb(roads.geometry.to_numpy(), hex=True)) + '/' + roads['slope'].astype(str).to_numpy()
+        if args.direction:
+            keys = keys + '/' + roads['grade'].astype(str).to_numpy()
+        return keys + '#' + keys.groupby(keys).cumcount().astype(str)
+
+    # The accumulated image only makes sense for the same grid, and the same
+    # misery index values
+    direction = (('to-centre', 'from-centre').index(args.direction) + 1, *args.centre) if args.direction else (0, 0, 0)
+    acc_meta = np.array([img_xy[0], img_xy[1], img_size[0], img_size[1], args.resolution, args.splat == 'line', args.max_slope, *direction], dtype=float)
+    acc_table = f'{args.profile}/{mi_table.digest()}'
+
+    if args.previous:
+        # only add and remove the segments which changed
+        previous = read_roads(args.previous, columns=['slope', 'grade'] if args.direction else ['slope'])
+        old_keys = segment_keys(previous)
+        new_keys = segment_keys(roads)
+        removed = previous.loc[~old_keys.isin(set(new_keys)).to_numpy()]
+        added = roads.loc[~new_keys.isin(set(old_keys)).to_numpy()]
+        print(f"{len(removed)} segments removed, {len(added)} added", flush=True)
+
+        saved = np.load(args.accumulator)
+        if not np.array_equal(saved['meta'], acc_meta):
+            raise SystemExit("the accumulated image was made with another grid, splat mode, maximum slope or direction")
+        if 'table' not in saved or str(saved['table']) != acc_table:
+            raise SystemExit("the accumulated image was made with another misery index table or --profile")
+        acc = saved['acc']
+
+        old_col, old_row, old_channels = contributions(removed)
+        col, row, channels = contributions(added)
+        np.subtract.at(acc, (old_row, old_col), np.stack(old_channels, axis=-1))
+        np.add.at(acc, (row, col), np.stack(channels, axis=-1))
+        dirty_col, dirty_row = np.concatenate((old_col, col)), np.concatenate((old_row, row))
+    else:
+        col, row, channels = contributions(roads)
+
+    from rasterio.transform import Affine
+    from rasterio.windows import Window
 
-print("loading data", flush=True)
+    def geotiff_profile(width, height, resolution, xy=img_xy):
+        """ profile for our output, `xy` is the bottom-left corner """
+        return rasterio.profiles.DefaultGTiffProfile(
+            count=1,
+            width=width,
+            height=height,
+            crs=roads.crs,
+            dtype=rasterio.float32,
+            transform=Affine.translation(xy[0], xy[1] + height * resolution) * Affine.scale(resolution, -resolution))
 
-roads = gpd.GeoDataFrame.from_file(args.slopes)
-if args.water:
-    water = gpd.GeoDataFrame.from_file(args.water)
-bbox_total = BBOX(*json.load(open(args.bbox)))
-misery_index_json = json.load(open(args.misery_index))
+    out_meta = geotiff_profile(img_size[0], img_size[1], args.resolution)
 
-print("making image", flush=True)
+    if args.tile_size:
+        # Make the image one tile at a time. Every tile is accumulated with a
+        # margin as wide as the reach of the blur, so the blur is seamless across
+        # tile edges.
+        # Memory use only depends on the tile size and the number of segments.
+        halo = blur_radius(args.blur, args.blur_engine)
+        tile = args.tile_size
 
-# create our image and calculate how the pixel coordinates line up
-# the pixels are aligned on an integer multiple of the resolution
+        order = np.argsort(row, kind='stable')
+        col, row = col[order], row[order]
+        channels = [c[order] for c in channels]
 
-img_xy = (floor(bbox_total.x / args.resolution) * args.resolution,
-          floor(bbox_total.y / args.resolution) * args.resolution )
+        with rasterio.open(args.output, "w", **out_meta) as dest:
+            for r0 in range(0, img_size[1], tile):
+                r1 = min(r0 + tile, img_size[1])
+                hr0, hr1 = max(0, r0 - halo), min(img_size[1], r1 + halo)
+                band = slice(np.searchsorted(row, hr0), np.searchsorted(row, hr1))
+                band_col, band_row = col[band], row[band]
 
-def scale_pixel(x, y):
-    return int(x - img_xy[0]) // args.resolution, int(y - img_xy[1]) // args.resolution
+                for c0 in range(0, img_size[0], tile):
+                    c1 = min(c0 + tile, img_size[0])
+                    hc0, hc1 = max(0, c0 - halo), min(img_size[0], c1 + halo)
+                    sel = (band_col >= hc0) & (band_col < hc1)
 
-img_size = scale_pixel(bbox_total.x2(), bbox_total.y2())
-img_size = (img_size[0] + 1, img_size[1] + 1)
+                    acc = accumulate(band_col[sel], band_row[sel], [c[band][sel] for c in channels],
+                                     window=(hc0, hr0, hc1 - hc0, hr1 - hr0), dtype=np.float32)
+                    img = misery_image(acc)[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0]
+                    dest.write(img, 1, window=Window(c0, r0, c1 - c0, r1 - r0))
 
-bbox_img = BBOX(*img_xy, img_size[0] * args.resolution, img_size[1] * args.resolution)
+                print(end=f'{r1}/{img_size[1]} rows\r', flush=True)
+        print()
+        print("written " + args.output)
 
-def pixel_for(x, y):
-    px = scale_pixel(x, y)
-    if px[0] < 0 or px[1] < 0 or px[0] >= img_size[0] or px[1] >= img_size[1]:
-        return None
-    return px
+    elif args.previous:
+        # Only pixels within the reach of the blur kernel of a changed pixel
+        # change. We go by tiles: the tiles with a changed pixel, and the tiles
+        # within reach of those, are blurred again, each with a margin of the
+        # same reach.
+        if len(dirty_col):
+            from scipy.ndimage import maximum_filter
 
-# image with two channels: misery index and pixel weight
-img = np.zeros((img_size[1], img_size[0], 2))
+            halo = blur_radius(args.blur, args.blur_engine)
+            tile = max(64, halo)
+            dirty = np.zeros((-(-img_size[1] // tile), -(-img_size[0] // tile)), dtype=bool)
+            dirty[dirty_row // tile, dirty_col // tile] = True
+            dirty = maximum_filter(dirty, size=2 * -(-halo // tile) + 1)
 
+            with rasterio.open(args.output, "r+") as dest:
+                for tr, tc in np.argwhere(dirty):
+                    r0, r1 = tr * tile, min((tr + 1) * tile, img_size[1])
+                    c0, c1 = tc * tile, min((tc + 1) * tile, img_size[0])
+                    hc0, hc1 = max(0, c0 - halo), min(img_size[0], c1 + halo)
+                    hr0, hr1 = max(0, r0 - halo), min(img_size[1], r1 + halo)
 
-# for every road segment, convert slope to misery index,
-# and splat on image
+                    img = misery_image(acc[hr0:hr1, hc0:hc1].copy())[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0]
+                    dest.write(img.astype(np.float32), 1, window=Window(c0, r0, c1 - c0, r1 - r0))
+            print(f"updated {np.count_nonzero(dirty)} tiles of {tile}×{tile} pixels of " + args.output)
 
-misery_index_sl = np.array([m['slope'] for m in misery_index_json])
-misery_index_mi = np.array([m['mi'] for m in misery_index_json])
+    elif args.network:
+        img = network_image(roads)
 
-for slope, centroid, length in zip(roads["slope"], roads.geometry.centroid, roads.geometry.length):
-    px = pixel_for(centroid.x, centroid.y)
-    # very high slopes are usually artefacts of the DEM following
-    # the slope under a bridge
-    if px is not None and slope <= 0.25:
-        mi, = np.interp([slope], misery_index_sl, misery_index_mi)
-        img[img_size[1] - 1 - px[1], px[0], :] += [mi * length, length]
+        with rasterio.open(args.output, "w", **out_meta) as dest:
+            dest.write_band(1, img)
 
-# filter, and discard pixels with too low weight
+        print("written " + args.output)
 
-img = gaussian_filter1d(img, args.blur, 0)
-img = gaussian_filter1d(img, args.blur, 1)
-img[:, :, 0] =  np.where(img[:, :, 1] > args.resolution * .4, img[:, :, 0], np.nan)
-img = img[:, :, 0] / img[:, :, 1]
+    else:
+        acc = accumulate(col, row, channels)
+        img = misery_image(acc.copy())
 
-# write geotiff
+        # write geotiff
 
-from rasterio.transform import Affine
+        with rasterio.open(args.output, "w", **out_meta) as dest:
+            dest.write_band(1, img)
 
-out_meta = rasterio.profiles.DefaultGTiffProfile(
-    count=1,
-    width=img.shape[1],
-    height=img.shape[0],
-    crs=roads.crs,
-    dtype=rasterio.float32,
-    transform=Affine.translation(bbox_img.x, bbox_img.y2()) * Affine.scale(args.resolution, -args.resolution))
+        print("written " + args.output)
 
-with rasterio.open(args.output, "w", **out_meta) as dest:
-    dest.write_band(1, img)
+    if not args.tile_size:
+        if args.accumulator:
+            np.savez(args.accumulator, acc=acc, meta=acc_meta, table=acc_table)
+            print("written " + args.accumulator)
 
-print("written " + args.output)
+        # coarser levels come from the same accumulated image. They are small,
+        # so we just make them again
+        for factor, blur in args.pyramid:
+            # the level is blurred in its own, larger pixels. By default the
+            # blur is as wide as the one of the full resolution image
+            if blur is None:
+                blur = args.blur / factor
+            level_acc, level_xy = block_sum(acc, factor)
+            level_img = misery_image(level_acc, blur, args.resolution * factor)
+            base, ext = os.path.splitext(args.output)
+            level_output = f'{base}-x{factor}{ext}'
+            level_meta = geotiff_profile(level_img.shape[1], level_img.shape[0], args.resolution * factor, level_xy)
+            with rasterio.open(level_output, "w", **level_meta) as dest:
+                dest.write_band(1, level_img)
+            print("written " + level_output)
 
-# preview the map data:
+    if not args.tile_size and not args.previous:
+        # preview the map data:
 
-fig, ax = plt.subplots()
-ax.imshow(img, extent=bbox_img.xxyy(), cmap=our_cm, vmin=0, vmax=1.4)
-roads.plot(ax=ax, column='slope', linewidth=2, cmap='turbo', vmax=0.20)
-if args.water:
-    water.plot(ax=ax, linewidth=0.5, color=(0.7, 0.9, 1), edgecolor=(0.2, 0.5, 0.8))
-plt.show()
+        fig, ax = plt.subplots()
+        ax.imshow(img, extent=bbox_img.xxyy(), cmap=our_cm, vmin=0, vmax=1.4)
+        roads.plot(ax=ax, column='slope', linewidth=2, cmap='turbo', vmax=0.20)
+        if args.water:
+            water.plot(ax=ax, linewidth=0.5, color=(0.7, 0.9, 1), edgecolor=(0.2, 0.5, 0.8))
+        plt.show()
@@ -0,0 +1,65 @@
+import os
+
+import geopandas as gpd
+import pyogrio
+
+"""
+Reading and writing the road data sets we pass between our scripts.
+
+The format follows from the file name extension: .parquet (GeoParquet) and
+.feather/.arrow are columnar binary formats which are a lot faster to read and
+write than text. They need `pyarrow`. Anything else (like .geojson) goes
+through OGR.
+"""
+
+BINARY_FORMATS = {
+    '.parquet': (gpd.read_parquet, gpd.GeoDataFrame.to_parquet),
+    '.feather': (gpd.read_feather, gpd.GeoDataFrame.to_feather),
+    '.arrow':   (gpd.read_feather, gpd.GeoDataFrame.to_feather),
+}
+
+
+def read_roads(f, columns=None):
+    """ read a road data set, optionally only the given columns (and the geometry) """
+    ext = os.path.splitext(f)[1].lower()
+    if ext in BINARY_FORMATS:
+        if columns is not None:
+            columns = list(columns) + ['geometry']
+        return BINARY_FORMATS[ext][0](f, columns=columns)
+    return gpd.read_file(f, columns=columns)
+
+
+def read_roads_chunks(f, columns=None, where=None, bbox=None, chunk_size=100000):
+    """ read a data set through OGR, `chunk_size` rows at a time
+
+    `where` is an SQL WHERE clause and `bbox` a (x1, y1, x2, y2) extent, both
+    are applied by the reader, so rows which don’t match are never converted.
+    The rows come in one pass over the file, as Arrow record batches. This
+    needs `pyarrow`.
+
+    yields GeoDataFrames """
+    with pyogrio.open_arrow(f, columns=columns, where=where, bbox=bbox,
+                            batch_size=chunk_size, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        for batch in reader:
+            if not batch.num_rows:
+                continue
+            chunk = batch.to_pandas()
+            geometry = gpd.GeoSeries.from_wkb(chunk.pop(geometry_name), crs=meta['crs'])
+            yield gpd.GeoDataFrame(chunk, geometry=geometry)
+
+
+def sql_list(values):
+    """ format values as a list for an SQL IN clause """
+    return '(' + ', '.join(f"'{v.replace(chr(39), chr(39) * 2)}'" if isinstance(v, str) else str(v) for v in values) + ')'
+
+
+def write_roads(roads, f):
+    """ write a road data set """
+    ext = os.path.splitext(f)[1].lower()
+    if ext in BINARY_FORMATS:
+        BINARY_FORMATS[ext][1](roads, f, index=False)
+    elif ext in ('.geojson', '.json'):
+        roads.to_file(f, driver='GeoJSON')
+    else:
+        roads.to_file(f)
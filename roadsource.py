@@ -0,0 +1,195 @@
+import configparser
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+
+from roadio import *
+
+"""
+Where the roads come from.
+
+A road source reads a road network and returns the roads we consider as a
+GeoDataFrame with a `road_type` column ('L' for large, 'M' for medium roads)
+and LineString geometries in the projection of the DEM.
+
+ - `ShapefileRoads`: the HackAKL roads data set (from Auckland Council), or
+   anything else OGR reads with the same columns
+ - `OsmRoads`: an OpenStreetMap extract (.osm.pbf), streamed way by way. This
+   needs `pyosmium`.
+"""
+
+
+class ShapefileRoads:
+    """ the HackAKL roads data set
+
+    Roads are classified with the CLASSIFICA column, plus a few kludges. """
+
+    # which roads to consider: only the major roads for now
+    # these often have a favourable elevation profile and are often
+    # where you cycle for long distances anyway
+    # bicycle paths are so rare we can ignore them (sadly, and they don’t show
+    # up as a distinct category in our data)
+    class_table = {
+     'Arterial urban'   : 'L',
+     'Arterial rural'   : 'L',
+     'Medium urban'     : 'M',
+     'Medium rural'     : 'M',
+    }
+
+    # kludges: roads we want regardless of their class
+    extra_ids = (2165640, 1955770, 1955710) # pretty sure that ramp is not limited access anymore
+    extra_names = ("DAIRY FLAT HIGHWAY", "ALBANY EXPRESSWAY") # former SH17
+
+    columns = ['CLASSIFICA', 'USE_TYPE', 'PRIMARY_RO', 'ID']
+
+    def __init__(self, f):
+        self.f = f
+
+    def where(self):
+        """ every road we could possibly keep. The reader skips everything else """
+        return f"CLASSIFICA IN {sql_list(self.class_table)} OR ID IN {sql_list(self.extra_ids)} OR PRIMARY_RO IN {sql_list(self.extra_names)}"
+
+    def select(self, roads):
+        """ add a road_type column and drop the roads we don’t consider """
+
+        # generate a class column. Initially use table
+        road_type = roads['CLASSIFICA'].map(self.class_table)
+        road_type = road_type.mask(road_type.isna(),           False)
+
+        # insert kludges here:
+        road_type = road_type.mask(roads['USE_TYPE'] == "Vehicle only",           False)
+        road_type = road_type.mask(roads['ID'].isin(self.extra_ids), 'L')
+        road_type = road_type.mask(roads['PRIMARY_RO'].isin(self.extra_names), 'L')
+        road_type = road_type.mask(roads['PRIMARY_RO'].str.contains("BUSWAY", na=False), False)
+        road_type = road_type.mask(roads['CLASSIFICA'] == "Motorway", False)
+
+        roads2 = pd.DataFrame({'road_type': road_type})
+        roads = gpd.GeoDataFrame(roads2, geometry=roads.geometry, crs=roads.crs)
+        return roads.loc[road_type.astype(bool)]
+
+    def read(self, bbox=None):
+        """ read the roads we consider, chunk by chunk, so only those are kept in memory
+
+        bbox: only roads which overlap this (x1, y1, x2, y2) extent """
+        parts = []
+        for chunk in read_roads_chunks(self.f, columns=self.columns, where=self.where(), bbox=bbox):
+            parts.append(self.select(chunk))
+            print(end=f'{sum(len(p) for p in parts)} roads\r', flush=True)
+        print()
+        if not parts:
+            return gpd.GeoDataFrame({'road_type': []}, geometry=[], crs=pyogrio.read_info(self.f)['crs'])
+        return pd.concat(parts, ignore_index=True)
+
+
+class OsmRoads:
+    """ the roads in an OpenStreetMap extract
+
+    Roads are classified with their highway tag. `class_table` maps highway tags
+    to a road type, other ways are skipped, and so are ways which bicycles
+    aren’t allowed on. The file is read in one pass: every `chunk_size` roads
+    are turned into LineStrings and projected to `crs`, so we only hold on to
+    the roads we keep.
+
+    Ways only refer to their nodes, so the reader keeps the location of every
+    node in an index. `node_index` is the osmium index type: the file based
+    ones (the default `sparse_file_array`, or `dense_file_array` for large
+    extracts) use a temporary file instead of memory. """
+
+    # motorways and their links are limited access, and residential streets
+    # are too small
+    class_table = {
+     'trunk'     : 'L',
+     'primary'   : 'L',
+     'secondary' : 'L',
+     'tertiary'  : 'M',
+    }
+
+    def __init__(self, f, class_table=None, crs='EPSG:2193', chunk_size=100000, node_index='sparse_file_array'):
+        self.f = f
+        if class_table is not None:
+            self.class_table = class_table
+        self.crs = crs
+        self.chunk_size = chunk_size
+        self.node_index = node_index
+
+    def read(self, bbox=None):
+        """ read the roads we consider
+
+        bbox: only roads which overlap this (x1, y1, x2, y2) extent, in `crs` """
+        import osmium
+
+        class_table = self.class_table
+        chunk_size = self.chunk_size
+        parts = []
+        road_type = []
+        coords = []
+        count = []
+
+        def flush():
+            if not road_type:
+                return
+            lines = shapely.linestrings(np.array(coords), indices=np.repeat(np.arange(len(count)), count))
+            chunk = gpd.GeoDataFrame({'road_type': road_type}, geometry=lines, crs='EPSG:4326').to_crs(self.crs)
+            if bbox is not None:
+                chunk = chunk.loc[shapely.intersects(chunk.geometry.to_numpy(), shapely.box(*bbox))]
+            parts.append(chunk)
+            road_type.clear()
+            coords.clear()
+            count.clear()
+            print(end=f'{sum(len(p) for p in parts)} roads\r', flush=True)
+
+        class Handler(osmium.SimpleHandler):
+            def way(self, w):
+                rt = class_table.get(w.tags.get('highway', ''), None)
+                if rt is None or w.tags.get('bicycle', '') == 'no' or w.tags.get('access', '') == 'no':
+                    return
+                try:
+                    xy = [(n.lon, n.lat) for n in w.nodes]
+                except osmium.InvalidLocationError:
+                    # a node outside the extract
+                    return
+                if len(xy) < 2:
+                    return
+                road_type.append(rt)
+                coords.extend(xy)
+                count.append(len(xy))
+                if len(count) >= chunk_size:
+                    flush()
+
+        # ways only refer to their nodes, so we need an index of node locations
+        idx, tmp = self.node_index, None
+        if idx.endswith('_file_array'):
+            fd, tmp = tempfile.mkstemp(suffix='.nodes')
+            os.close(fd)
+            idx += ',' + tmp
+        try:
+            Handler().apply_file(self.f, locations=True, idx=idx)
+        finally:
+            if tmp:
+                os.remove(tmp)
+        flush()
+        print()
+
+        if not parts:
+            return gpd.GeoDataFrame({'road_type': []}, geometry=[], crs=self.crs)
+        return pd.concat(parts, ignore_index=True)
+
+
+def read_class_table(f):
+    """ read a mapping from highway tag to road type from the [highway] section of an ini file """
+    config = configparser.ConfigParser()
+    config.read(f, encoding='utf-8')
+    return dict(config['highway'].items())
+
+
+def road_source(f, osm_classes=None, crs='EPSG:2193', osm_index='sparse_file_array'):
+    """ the road source for a file: OpenStreetMap data for .osm.pbf (or .osm) files,
+    otherwise a shapefile with the HackAKL columns """
+    if f.lower().endswith(('.pbf', '.osm')):
+        return OsmRoads(f, read_class_table(osm_classes) if osm_classes else None, crs, node_index=osm_index)
+    return ShapefileRoads(f)
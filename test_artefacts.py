@@ -0,0 +1,91 @@
+import numpy as np
+
+from artefacts import *
+
+
+def straight_road(elevations, step=10.):
+    """ segments along the x axis with these node elevations """
+    x = np.arange(len(elevations)) * step
+    p1 = np.stack((x[:-1], np.zeros(len(x) - 1)), axis=1)
+    p2 = np.stack((x[1:], np.zeros(len(x) - 1)), axis=1)
+    el = np.array(elevations, dtype=float)
+    return p1, p2, np.full(len(x) - 1, step), el[:-1], el[1:]
+
+
+def test_single_segment_dip():
+    p1, p2, length, el1, el2 = straight_road([10, 10, -10, 10, 10])
+    el1, el2, fixed = fix_artefacts(p1, p2, length, el1, el2)
+    np.testing.assert_allclose(el2 - el1, 0)
+    np.testing.assert_array_equal(fixed, [False, True, True, False])
+
+
+def test_multi_segment_dip():
+    p1, p2, length, el1, el2 = straight_road([10, 10, 0, -10, 0, 10, 10])
+    el1, el2, fixed = fix_artefacts(p1, p2, length, el1, el2)
+    np.testing.assert_allclose(el2 - el1, 0)
+    np.testing.assert_array_equal(fixed, [False, True, True, True, True, False])
+
+
+def test_dip_relative_to_neighbours():
+    # not over max_grade, but much steeper than the road on either side
+    p1, p2, length, el1, el2 = straight_road([10, 10.1, 10.2, 9, 7.8, 9, 10.3, 10.4])
+    el1, el2, fixed = fix_artefacts(p1, p2, length, el1, el2)
+    assert np.all(np.abs(el2 - el1) / length < 0.02)
+    # a steady climb is left alone
+    p1, p2, length, el1, el2 = straight_road([0, 1.5, 3, 4.5, 6])
+    assert not np.any(fix_artefacts(p1, p2, length, el1, el2)[2])
+
+
+def test_dip_across_roads():
+    # the same dip, split over two roads, one of them drawn the other way around
+    p1, p2, length, el1, el2 = straight_road([10, 10, 0, -10, 0, 10, 10])
+    order = np.array([4, 0, 5, 2, 1, 3])
+    p1, p2, el1, el2 = p1[order], p2[order], el1[order], el2[order]
+    p1[[0, 3]], p2[[0, 3]] = p2[[0, 3]], p1[[0, 3]]
+    el1[[0, 3]], el2[[0, 3]] = el2[[0, 3]], el1[[0, 3]]
+    el1, el2, fixed = fix_artefacts(p1, p2, length, el1, el2)
+    np.testing.assert_allclose(el1, 10)
+    np.testing.assert_allclose(el2, 10)
+
+
+def test_junction():
+    # a side road at the bottom of the dip gets the new elevation as well
+    p1, p2, length, el1, el2 = straight_road([10, 10, 0, -10, 0, 10, 10])
+    p1 = np.vstack((p1, [[30, 0]]))
+    p2 = np.vstack((p2, [[30, 10]]))
+    el1, el2, fixed = fix_artefacts(p1, p2, np.append(length, 10), np.append(el1, -10), np.append(el2, -5))
+    np.testing.assert_allclose(el1, 10)
+    np.testing.assert_allclose(el2[:-1], 10)
+    assert fixed[-1]
+
+
+def test_chains():
+    # two roads meeting at (10, 0), and a loop
+    p1 = np.array([[0, 0], [20, 0], [100, 0], [110, 0], [110, 10]], dtype=float)
+    p2 = np.array([[10, 0], [10, 0], [110, 0], [110, 10], [100, 0]], dtype=float)
+    order, reverse, chain = chains(p1, p2)
+    assert len(np.unique(chain)) == 2
+    first = chain == chain[order == 0][0]
+    assert sorted(order[first]) == [0, 1]
+    assert reverse[first].tolist() in ([False, True], [False, True][::-1])
+
+
+def test_nothing_steep():
+    p1, p2, length, el1, el2 = straight_road([0, 0.1, 0.2, 0.3, 0.4])
+    new1, new2, fixed = fix_artefacts(p1, p2, length, el1, el2)
+    np.testing.assert_array_equal(new1, el1)
+    np.testing.assert_array_equal(new2, el2)
+    assert not np.any(fixed)
+
+
+def test_junction_fixed():
+    # every road at a junction in the dip counts as fixed
+    p1 = np.array([[20, 30], [10, 40], [0, 10], [20, 30], [40, 20]], dtype=float)
+    p2 = np.array([[30, 40], [20, 30], [20, 30], [20, 20], [40, 0]], dtype=float)
+    el = np.array([[6.3, 13.2], [27, 6.3], [14.8, 6.3], [6.3, 8.5], [29.8, 15.2]])
+    length = np.hypot(*(p2 - p1).T)
+    el1, el2, fixed = fix_artefacts(p1, p2, length, el[:, 0], el[:, 1])
+    np.testing.assert_array_equal(fixed, [True, True, True, True, False])
+    # the roads at the junction share its new elevation
+    assert np.allclose([el1[0], el2[1], el2[2], el1[3]], el1[0])
+    assert el1[0] != 6.3
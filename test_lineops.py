@@ -0,0 +1,17 @@
+import numpy as np
+import shapely
+
+from lineops import *
+
+
+def test_fill_profile_gaps():
+    lines = np.array([shapely.LineString([(0, 0), (40, 0)]), shapely.LineString([(0, 10), (20, 10)])])
+    xy, line_index, dist = sample_points(lines, 10)
+    assert list(line_index) == [0, 0, 0, 0, 0, 1, 1, 1]
+    el = np.array([0, 1, np.nan, np.nan, 4, np.nan, 5, 6])
+    filled = fill_profile_gaps(el, line_index, dist)
+    # inside a line the gap is interpolated
+    np.testing.assert_allclose(filled[:5], [0, 1, 2, 3, 4])
+    # the end of a line isn’t filled from the line before it
+    assert np.isnan(filled[5])
+    np.testing.assert_allclose(filled[6:], [5, 6])
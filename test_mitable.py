@@ -0,0 +1,24 @@
+import numpy as np
+
+from mitable import *
+
+
+def table():
+    slopes = np.linspace(0, 0.3, 31)
+    return slopes, MiseryTable(0, 0.01, {'mi': slopes ** 2, 'mi_up': slopes * 2, 'mi_down': slopes * .5})
+
+
+def test_lookup_matches_interp():
+    slopes, t = table()
+    x = np.array([-0.1, 0, 0.005, 0.123, 0.3, 0.5])
+    np.testing.assert_allclose(t.lookup(x), np.interp(x, slopes, slopes ** 2))
+
+
+def test_lookup_not_finite():
+    _, t = table()
+    mi = t.lookup(np.array([0.1, np.nan, np.inf, -np.inf]))
+    assert np.isclose(mi[0], 0.01)
+    assert np.all(np.isnan(mi[1:]))
+    mi = t.lookup_signed(np.array([-0.1, np.nan, 0.1]))
+    np.testing.assert_allclose(mi[[0, 2]], [0.05, 0.2])
+    assert np.isnan(mi[1])
@@ -0,0 +1,31 @@
+import geopandas as gpd
+import shapely
+
+from roadsource import *
+
+
+def write_shapefile(f):
+    gpd.GeoDataFrame({
+        'CLASSIFICA': ['Arterial urban', 'Local road'],
+        'USE_TYPE': ['All', 'All'],
+        'PRIMARY_RO': ['GREAT NORTH ROAD', 'SOME STREET'],
+        'ID': [1, 2]},
+        geometry=[shapely.LineString([(0, 0), (100, 0)]), shapely.LineString([(0, 10), (100, 10)])],
+        crs='EPSG:2193').to_file(f)
+
+
+def test_shapefile_roads(tmp_path):
+    f = str(tmp_path / 'roads.shp')
+    write_shapefile(f)
+    roads = ShapefileRoads(f).read()
+    assert list(roads['road_type']) == ['L']
+    assert roads.crs == 'EPSG:2193'
+
+
+def test_shapefile_no_roads(tmp_path):
+    f = str(tmp_path / 'roads.shp')
+    write_shapefile(f)
+    roads = ShapefileRoads(f).read(bbox=(1000, 1000, 2000, 2000))
+    assert len(roads) == 0
+    assert 'road_type' in roads
+    assert roads.crs == 'EPSG:2193'